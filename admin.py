@@ -17,26 +17,46 @@
 from __future__ import with_statement
 from flask import Flask, request, session, abort, redirect, url_for, flash
 from functools import wraps
-from database import DB
-from models import User, Tag, Format, Status, Post, Page
+from database import DB, db_options
+from models import User, Tag, Format, Status, Post, Page, CompileJob, \
+                   refresh_published_post, post_tag_ids, \
+                   update_tag_counts, add_tombstone
 from datetime import datetime
-from sqlalchemy.sql import and_
-from flaskjk import Viewer, Paginator, validate_password, slugify
-from frontend import filter_public
-from forms import PostForm, PageForm, LoginForm
+from time import time
+from sqlalchemy import DateTime
+from sqlalchemy.sql import and_, func, literal
+from flaskjk import Viewer, validate_password, slugify
+from pagination import KeysetPaginator
+from cache import invalidate
+from forms import PostForm, PageForm, LoginForm, get_status, get_tags
+from lookups import lookups
+from jobs import Workers, queue_post, queue_page, pending_ids
+from profiling import Profiler
+from metrics import Metrics
 # }}}
 
 # Initialization {{{
 app = Flask(__name__, static_path=None)
 app.config.from_pyfile('config_admin.py')
 app.config.from_envvar('IMPOSTER_ADMIN_CONFIG', silent=True)
-db_session = DB(app.config['DATABASE']).get_session()
+db = DB(app.config['DATABASE'], **db_options(app.config))
+db_session = db.get_session()
 viewer = Viewer(app, 'admin')
-
-# base query used in all frontend retrieve queries
-public_posts_base = db_session.query(Post, Status, User).filter(filter_public())
+profiler = Profiler(app, db.get_engines(), viewer)
+metrics = Metrics(app, 'admin', app.config['PREFIX'])
+
+workers = None
+if app.config['COMPILE_ASYNC'] == 'thread':
+    workers = Workers(app.config['COMPILE_WORKERS'],
+                      db.get_session(primary=True),
+                      app.config['REPL_TAGS'],
+                      app.config['CACHE_STAMP_FILE'],
+                      app.config['COMPILE_POLL_INTERVAL'])
 # }}}
 
+# sorts drafts without publication date before all other posts and pages
+DRAFTS_PUBDATE = datetime(9999, 12, 31)
+
 # Helper functions {{{
 def login_required(fun):
     """Decorator for functions which require an authorized user"""
@@ -49,15 +69,22 @@ def login_required(fun):
 
     return decorated_function
 
-def get_format(value):
-    """Retrieve Format object based on given String"""
-    query = Format.query.filter(Format.value==value)
-    return query.one()
+def writes(fun):
+    """Decorator for views changing data
+
+    They read from the primary database instead of a replica, and so do the
+    requests of the same user in the next DATABASE_STICKY_SECONDS, so the
+    user sees the changes before they reach the replicas.
+    """
+    @wraps(fun)
+    def decorated_function(*args, **kwargs):
+        """Decorated function"""
+        db_session().use_primary = True
+        session['primary_until'] = time() + \
+                app.config['DATABASE_STICKY_SECONDS']
+        return fun(*args, **kwargs)
 
-def get_status(value):
-    """Retrieve Status object based on given String"""
-    query = Status.query.filter(Status.value==value)
-    return query.one()
+    return decorated_function
 
 def get_post(post_id):
     """ Retrieve Post object based on given Post id"""
@@ -77,9 +104,20 @@ def get_page(page_id):
 
     return page
 
-def recalculate_tagcount(tag):
-    """Calculate how many times a given tag is used in public Posts"""
-    tag.count = public_posts_base.filter(Post.tags.contains(tag)).count()
+def pubdate_key(model):
+    """Return sort key for the admin lists of model: the publication date,
+    with the drafts which don't have one first, like PostgreSQL sorts NULL"""
+    return func.coalesce(model.pubdate, literal(DRAFTS_PUBDATE, DateTime),
+                         type_=DateTime)
+
+def compile_later():
+    """Return True if markup should be compiled by background workers"""
+    return app.config['COMPILE_ASYNC'] is not None
+
+def notify_workers():
+    """Wake up the worker threads after queueing jobs"""
+    if workers is not None:
+        workers.notify()
 
 # }}}
 
@@ -90,6 +128,13 @@ def strftime(value, format='%a, %d %b %Y %H:%M:%S %Z'):
     return value.strftime(format)
 # }}}
 
+# Request handlers {{{
+@app.before_request
+def route_queries():
+    """Read from the primary database shortly after the user saved"""
+    db_session().use_primary = session.get('primary_until', 0) > time()
+# }}}
+
 # Views {{{
 @viewer.view('static_files')
 def static_files(filename):
@@ -143,23 +188,27 @@ def logout():
 @login_required
 def posts_list(page=1):
     """Paginated view of all posts"""
-    p_order = Post.pubdate.desc()
     posts = db_session.query(Post).filter(
-        Post.user_id==session['user_id']).order_by(Post.pubdate.desc())
-    paginator = Paginator(posts, app.config['ENTRIES_PER_PAGE'], page,
-                          'posts_list')
-    return viewer.render('posts_list.html', posts=posts, paginator=paginator)
+        Post.user_id==session['user_id'])
+    paginator = KeysetPaginator(posts, app.config['ENTRIES_PER_PAGE'], page,
+                                'posts_list', pubdate_key(Post), Post.id)
+    compiling = pending_ids(db_session, CompileJob.post_id,
+                            [post.id for post in paginator.entries])
+    return viewer.render('posts_list.html', posts=posts, paginator=paginator,
+                         compiling=compiling)
 
 @viewer.view('pages_list')
 @login_required
 def pages_list(page=1):
     """Paginated view of all pages"""
-    p_order = Page.pubdate.desc()
     pages = db_session.query(Page).filter(
-        Page.user_id==session['user_id']).order_by(Page.pubdate.desc())
-    paginator = Paginator(pages, app.config['ENTRIES_PER_PAGE'], page,
-                          'pages_list')
-    return viewer.render('pages_list.html', pages=pages, paginator=paginator)
+        Page.user_id==session['user_id'])
+    paginator = KeysetPaginator(pages, app.config['ENTRIES_PER_PAGE'], page,
+                                'pages_list', pubdate_key(Page), Page.id)
+    compiling = pending_ids(db_session, CompileJob.page_id,
+                            [page.id for page in paginator.entries])
+    return viewer.render('pages_list.html', pages=pages, paginator=paginator,
+                         compiling=compiling)
 
 @viewer.view('index')
 @login_required
@@ -173,11 +222,12 @@ def index():
 
 @viewer.view('recalculate_tagcounts')
 @login_required
+@writes
 def recalculate_tagcounts():
     """Recount all tag uses"""
-    for tag in db_session.query(Tag):
-        recalculate_tagcount(tag)
+    update_tag_counts(db_session)
     db_session.commit()
+    invalidate(app.config['CACHE_STAMP_FILE'])
     return redirect(url_for('index'))
 
 @viewer.view('new_post')
@@ -185,13 +235,16 @@ def recalculate_tagcounts():
 @login_required
 def edit_post(post_id=None, post_form=None):
     """Render form to edit a Post"""
-    formats = db_session.query(Format).all()
-    statuses = db_session.query(Status).all()
+    formats = lookups.all(db_session, Format)
+    statuses = lookups.all(db_session, Status)
     post = None
     form = None
+    compiling = False
 
     if post_id:
         post = get_post(post_id)
+        compiling = bool(pending_ids(db_session, CompileJob.post_id,
+                                     [post.id]))
 
     if post_form is None:
         form = PostForm(obj=post)
@@ -201,12 +254,14 @@ def edit_post(post_id=None, post_form=None):
     return viewer.render('edit_post.html',
                          form=form,
                          post=post,
+                         compiling=compiling,
                          formats=formats,
                          statuses=statuses)
 
 @viewer.view('save_new_post', methods=['POST'])
 @viewer.view('save_post', methods=['POST'])
 @login_required
+@writes
 def save_post(post_id=None):
     """Save Post to database
 
@@ -214,7 +269,7 @@ def save_post(post_id=None):
     the existing Post will be updated.
     """
     message = 'Post updated'
-    orig_tags = []
+    orig_tag_ids = []
 
     post_form = PostForm(request.form)
 
@@ -230,13 +285,14 @@ def save_post(post_id=None):
         post.createdate = datetime.now()
     else:
         post = get_post(post_id)
-        orig_tags = [tag for tag in post.tags]
+        orig_tag_ids = post_tag_ids(db_session, post.id)
 
     post_form.populate_obj(post)
     post.lastmoddate = datetime.now()
 
-    # compile input to html
-    post.compile(app.config['REPL_TAGS'])
+    # compile input to html, unless the workers will
+    if not compile_later():
+        post.compile(db_session, app.config['REPL_TAGS'])
 
     # update pubdate if post's pubdate is None and its status is set
     # to public
@@ -254,16 +310,22 @@ def save_post(post_id=None):
         db_session.add(post)
         message = 'New post was successfully added'
 
-    db_session.commit()
-
-    for tag in orig_tags:
-        recalculate_tagcount(tag)
-
-    for tag in post.tags:
-        if tag not in orig_tags:
-            recalculate_tagcount(tag)
+    # create missing tags after compiling, rendering may write to the
+    # database on a connection of its own
+    post.tags = get_tags(post_form.tags.data)
 
+    # flush first, new posts and tags need their ids
+    db_session.flush()
+    refresh_published_post(db_session, post)
+    if compile_later():
+        queue_post(db_session, post, orig_tag_ids,
+                   post_tag_ids(db_session, post.id))
+    else:
+        update_tag_counts(db_session, set(orig_tag_ids) |
+                          set(post_tag_ids(db_session, post.id)))
     db_session.commit()
+    invalidate(app.config['CACHE_STAMP_FILE'])
+    notify_workers()
 
     flash(message, category='info')
 
@@ -274,13 +336,16 @@ def save_post(post_id=None):
 @login_required
 def edit_page(page_id=None, page_form=None):
     """Render form to edit a Page"""
-    formats = db_session.query(Format).all()
-    statuses = db_session.query(Status).all()
+    formats = lookups.all(db_session, Format)
+    statuses = lookups.all(db_session, Status)
     page = None
     form = None
+    compiling = False
 
     if page_id:
         page = get_page(page_id)
+        compiling = bool(pending_ids(db_session, CompileJob.page_id,
+                                     [page.id]))
 
     if page_form is None:
         form = PageForm(obj=page)
@@ -290,12 +355,14 @@ def edit_page(page_id=None, page_form=None):
     return viewer.render('edit_page.html',
                            form=form,
                            page=page,
+                           compiling=compiling,
                            formats=formats,
                            statuses=statuses)
 
 @viewer.view('save_new_page', methods=['POST'])
 @viewer.view('save_page', methods=['POST'])
 @login_required
+@writes
 def save_page(page_id=None):
     """Save Page to database
 
@@ -303,6 +370,7 @@ def save_page(page_id=None):
     the existing Page will be updated.
     """
     message = 'Page updated'
+    orig_slug = None
 
     page_form = PageForm(request.form)
 
@@ -317,12 +385,15 @@ def save_page(page_id=None):
         page.createdate = datetime.now()
     else:
         page = get_page(page_id)
+        if unicode(page.status) == 'public':
+            orig_slug = page.slug
 
     page_form.populate_obj(page)
     page.lastmoddate = datetime.now()
 
-    # compile input to html
-    page.compile(app.config['REPL_TAGS'])
+    # compile input to html, unless the workers will
+    if not compile_later():
+        page.compile(db_session, app.config['REPL_TAGS'])
 
     # update pubdate if page's pubdate is None and its status is set
     # to public
@@ -340,7 +411,18 @@ def save_page(page_id=None):
         db_session.add(page)
         message = 'New page was successfully added'
 
+    # let clients of the public API know the page disappeared from its URL
+    if orig_slug is not None and (unicode(page.status) != 'public' or
+                                  page.slug != orig_slug):
+        add_tombstone(db_session, 'page', page.id, orig_slug)
+
+    if compile_later():
+        # flush first, new pages need their ids
+        db_session.flush()
+        queue_page(db_session, page)
     db_session.commit()
+    invalidate(app.config['CACHE_STAMP_FILE'])
+    notify_workers()
 
     flash(message)
 
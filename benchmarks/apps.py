@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Description {{{
+"""
+    imposter.benchmarks.apps
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmark the views of the frontend, the public API and the admin
+
+    A database is generated by dataset.py, the apps are configured to use it
+    and every route is requested a number of times through the Flask test
+    client. Each app runs in a process of its own, like in production.
+
+    For every route the number of requests per second, the 50th and 99th
+    percentile of the latency and the number of SQL statements per request
+    are reported. All results are written to a JSON file; pass the file of an
+    earlier run with --compare to see what changed.
+
+    usage: apps.py [options]
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+from __future__ import with_statement
+import os
+import sys
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, os.pardir)
+sys.path.insert(0, ROOT)
+
+from datetime import datetime
+from math import ceil
+from subprocess import Popen, PIPE
+from tempfile import mkdtemp
+from time import time
+
+import json
+import platform
+import re
+import shutil
+import dataset
+# }}}
+
+APPS = ['frontend', 'public_api', 'admin']
+
+SECRET_KEY = 'benchmark'
+
+# settings of the apps, written to the config file passed to all of them
+CONFIG = """
+DEBUG = False
+DATABASE = %(database)r
+PUBLIC_API_DATABASE = %(database)r
+SECRET_KEY = %(secret_key)r
+CSRF_ENABLED = False
+WTF_CSRF_ENABLED = False
+CACHE_STAMP_FILE = %(stamp_file)r
+UPLOAD_PATH = %(directory)r
+PAGE_CACHE_DIR = %(cache_dir)r
+PUBLIC_API_CACHE_DIR = %(cache_dir)r
+RECOMPILE_CHECKPOINT_FILE = None
+MIGRATION_CHECKPOINT_FILE = None
+"""
+
+# settings disabling the caches for --no-cache
+NO_CACHE_CONFIG = """
+CACHE_TTL = 0
+PAGE_CACHE_BACKEND = None
+PUBLIC_API_CACHE_BACKEND = None
+PUBLIC_API_CACHE_SIZE = 0
+"""
+
+# Helper functions {{{
+def build_url(prefix, pattern, **values):
+    """Return URL for a route pattern like 'tag/<tag>/<int:page>.html'"""
+    return '/%s%s' % (prefix, re.sub(r'<(?:\w+:)?(\w+)>',
+                                     lambda match: str(values[match.group(1)]),
+                                     pattern))
+
+def percentile(values, percent):
+    """Return percentile of sorted values, by the nearest rank method"""
+    index = int(ceil(percent / 100.0 * len(values))) - 1
+    return values[max(index, 0)]
+
+def get_commit():
+    """Return id of the git commit of the tree, None if unknown"""
+    try:
+        process = Popen(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=PIPE,
+                        stderr=PIPE)
+        out = process.communicate()[0].strip()
+    except OSError:
+        return None
+    if process.returncode != 0:
+        return None
+    return out
+
+def write_config(directory, cache=True):
+    """Write config file for the apps to directory and return its path"""
+    filename = os.path.join(directory, 'config.py')
+    cache_dir = os.path.join(directory, 'cache')
+    os.mkdir(cache_dir)
+    config = CONFIG % dict(database='sqlite:///%s' %
+                                    os.path.join(directory, 'benchmark.db'),
+                           secret_key=SECRET_KEY,
+                           stamp_file=os.path.join(directory, 'cache.stamp'),
+                           directory=directory,
+                           cache_dir=cache_dir)
+    if not cache:
+        config += NO_CACHE_CONFIG
+    with open(filename, 'w') as config_file:
+        config_file.write(config)
+    return filename
+# }}}
+
+# Routes {{{
+def get_facts(db_session):
+    """Return dict of existing slugs, names and ids to put in the URLs"""
+    from models import Tag, Post, PublishedPost
+    now = datetime.now()
+    published = db_session.query(PublishedPost) \
+            .filter(PublishedPost.pubdate <= now) \
+            .order_by(PublishedPost.pubdate.desc())
+    post = published[published.count() / 2]
+    tag = db_session.query(Tag).order_by(Tag.count.desc()).first()
+    admin_post = db_session.query(Post).filter(Post.user_id==1) \
+            .order_by(Post.createdate.desc()).first()
+    # the form saving the post unchanged, apart from its tags and status
+    post_form = dict(title=admin_post.title, tags='tag1, tag2',
+                     pubdate=admin_post.pubdate.strftime('%Y-%m-%d %H:%M'),
+                     format='rest', status='draft',
+                     summary=admin_post.summary, content=admin_post.content)
+    return dict(slug=post.slug,
+                slugs=','.join(row.slug for row in published[:20]),
+                year=post.pubdate.year,
+                month='%02d' % post.pubdate.month,
+                day='%02d' % post.pubdate.day,
+                tag=tag.value,
+                username='user1',
+                cursor=int(time()) - 3600,
+                post_form=post_form,
+                post_id=admin_post.id,
+                page_id=1)
+
+def frontend_routes(config, facts):
+    """Return list of (route name, method, url, form data) tuples"""
+    url = lambda name, **values: build_url(config['PREFIX'],
+                                           config['ROUTES'][name],
+                                           **dict(facts, **values))
+    return [('show_postlist', 'GET', url('show_postlist', page=1), None),
+            ('show_postlist deep', 'GET', url('show_postlist', page=20),
+             None),
+            ('show_post', 'GET', url('show_post'), None),
+            ('show_postlist_by_tag_index', 'GET',
+             url('show_postlist_by_tag_index'), None),
+            ('show_postlist_by_username', 'GET',
+             url('show_postlist_by_username', page=1), None),
+            ('show_postlist_by_year_index', 'GET',
+             url('show_postlist_by_year_index'), None),
+            ('show_postlist_by_month_index', 'GET',
+             url('show_postlist_by_month_index'), None),
+            ('show_rss', 'GET', url('show_rss'), None),
+            ('show_atom', 'GET', url('show_atom'), None)]
+
+def public_api_routes(config, facts):
+    url = lambda name, **values: build_url(config['PUBLIC_API_PREFIX'],
+                                           config['PUBLIC_API_ROUTES'][name],
+                                           **dict(facts, **values))
+    return [('json_sluglist_latest', 'GET', url('json_sluglist_latest'),
+             None),
+            ('json_posts_latest', 'GET', url('json_posts_latest'), None),
+            ('json_post_by_slug', 'GET', url('json_post_by_slug'), None),
+            ('json_posts_by_slugs', 'GET', url('json_posts_by_slugs') +
+             '?slugs=' + facts['slugs'], None),
+            ('json_taglist', 'GET', url('json_taglist'), None),
+            ('json_sluglist_by_tag', 'GET', url('json_sluglist_by_tag'),
+             None),
+            ('json_changes', 'GET', url('json_changes') +
+             '?since=%d' % facts['cursor'], None),
+            ('json_statuslist', 'GET', url('json_statuslist'), None)]
+
+def admin_routes(config, facts):
+    url = lambda name, **values: build_url(config['PREFIX'],
+                                           config['ROUTES'][name],
+                                           **dict(facts, **values))
+    return [('index', 'GET', url('index'), None),
+            ('posts_list', 'GET', url('posts_list', page=1), None),
+            ('pages_list', 'GET', url('pages_list', page=1), None),
+            ('edit_post', 'GET', url('edit_post'), None),
+            ('edit_page', 'GET', url('edit_page'), None),
+            ('save_post', 'POST', url('save_post'), facts['post_form'])]
+
+ROUTES = dict(frontend=frontend_routes, public_api=public_api_routes,
+              admin=admin_routes)
+# }}}
+
+def run_app(name, config_file, requests, warmup):
+    """Benchmark the routes of an app, in the current process
+
+    Returns list of result dicts, one per route.
+    """
+    for app_name in APPS:
+        os.environ['IMPOSTER_%s_CONFIG' % app_name.upper()] = config_file
+    os.chdir(ROOT)
+    module = __import__(name)
+    app = module.app
+    from sqlalchemy import event
+    from database import engines
+
+    queries = [0]
+    def count_query(*args):
+        queries[0] += 1
+    for engine in engines.values():
+        event.listen(engine, 'before_cursor_execute', count_query)
+
+    facts = get_facts(module.db_session)
+    module.db_session.remove()
+    client = app.test_client()
+    if name == 'admin':
+        client.post(build_url(app.config['PREFIX'],
+                              app.config['ROUTES']['login']),
+                    data=dict(username='user1', password=dataset.PASSWORD))
+
+    results = []
+    for route, method, url, data in ROUTES[name](app.config, facts):
+        for i in range(warmup):
+            client.open(url, method=method, data=data)
+        timings = []
+        errors = 0
+        queries[0] = 0
+        for i in range(requests):
+            start = time()
+            response = client.open(url, method=method, data=data)
+            timings.append(time() - start)
+            if response.status_code >= 400:
+                errors += 1
+        timings.sort()
+        results.append(dict(app=name, route=route, method=method, url=url,
+                            requests=requests,
+                            requests_per_second=requests / sum(timings),
+                            p50_ms=percentile(timings, 50) * 1000,
+                            p99_ms=percentile(timings, 99) * 1000,
+                            mean_ms=sum(timings) / requests * 1000,
+                            queries_per_request=float(queries[0]) / requests,
+                            errors=errors))
+    return results
+
+def run(apps, requests, warmup, cache, dataset_options):
+    """Generate the database and benchmark the apps, each in a child
+    process. Returns dict with the results and the circumstances."""
+    directory = mkdtemp(prefix='imposter-benchmark-')
+    try:
+        start = time()
+        dataset.create(os.path.join(directory, 'benchmark.db'),
+                       **dict(dataset_options, secret_key=SECRET_KEY))
+        print('Generated dataset in %.1fs' % (time() - start))
+        config_file = write_config(directory, cache)
+
+        routes = []
+        for name in apps:
+            print('Benchmarking %s ...' % name)
+            result_file = os.path.join(directory, '%s.json' % name)
+            returncode = Popen([sys.executable, os.path.abspath(__file__),
+                                '--run-app', name, '--config', config_file,
+                                '--result', result_file,
+                                '--requests', str(requests),
+                                '--warmup', str(warmup)]).wait()
+            if returncode != 0:
+                raise RuntimeError('Benchmark of %s failed' % name)
+            with open(result_file) as results:
+                routes.extend(json.load(results))
+    finally:
+        shutil.rmtree(directory)
+
+    import sqlalchemy
+    return dict(date=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                commit=get_commit(),
+                python=platform.python_version(),
+                sqlalchemy=sqlalchemy.__version__,
+                dataset=dataset_options,
+                requests=requests,
+                warmup=warmup,
+                cache=cache,
+                routes=routes)
+
+# Reports {{{
+def key(result):
+    return '%s %s' % (result['app'], result['route'])
+
+def print_results(results):
+    print('%-42s %9s %9s %9s %8s %6s' % ('route', 'req/s', 'p50 (ms)',
+                                         'p99 (ms)', 'queries', 'errors'))
+    for result in results['routes']:
+        print('%-42s %9.1f %9.2f %9.2f %8.1f %6d' % (
+              key(result), result['requests_per_second'], result['p50_ms'],
+              result['p99_ms'], result['queries_per_request'],
+              result['errors']))
+
+def print_comparison(old, new, threshold):
+    """Print changes of latency and queries between two runs, marking
+    routes which got more than threshold (a fraction) slower"""
+    old_routes = dict((key(result), result) for result in old['routes'])
+    print('\nCompared to %s (%s)' % (old['date'], old.get('commit')))
+    for setting in ('dataset', 'requests', 'cache', 'python', 'sqlalchemy'):
+        if old.get(setting) != new.get(setting):
+            print('Warning: runs differ in %s: %r and %r' %
+                  (setting, old.get(setting), new.get(setting)))
+    print('%-42s %10s %10s %9s' % ('route', 'p50', 'p99', 'queries'))
+    for result in new['routes']:
+        before = old_routes.get(key(result))
+        if before is None:
+            continue
+        p50 = result['p50_ms'] / before['p50_ms'] - 1
+        p99 = result['p99_ms'] / before['p99_ms'] - 1
+        queries = result['queries_per_request'] - \
+                before['queries_per_request']
+        mark = ''
+        if p50 > threshold or queries > 0:
+            mark = ' REGRESSION'
+        print('%-42s %+9.1f%% %+9.1f%% %+9.1f%s' % (key(result), p50 * 100,
+                                                    p99 * 100, queries, mark))
+# }}}
+
+#---------------------------------------------------------------------------
+# MAIN RUN LOOP
+if __name__ == '__main__':
+    parser = dataset.option_parser('usage: %prog [options]')
+    parser.remove_option('--secret-key')
+    parser.add_option('--apps', default=','.join(APPS),
+                      help='comma separated apps to benchmark [%default]')
+    parser.add_option('--requests', type='int', default=200,
+                      help='requests per route [%default]')
+    parser.add_option('--warmup', type='int', default=5,
+                      help='untimed requests per route first [%default]')
+    parser.add_option('--no-cache', dest='cache', action='store_false',
+                      default=True, help='disable the response caches')
+    parser.add_option('--output', default='benchmark-results.json',
+                      help='file to write the results to [%default]')
+    parser.add_option('--compare', metavar='FILE',
+                      help='results of an earlier run to compare with')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='p50 increase marked as regression [%default]')
+    parser.add_option('--run-app', help='internal: benchmark one app')
+    parser.add_option('--config', help='internal: config file of the apps')
+    parser.add_option('--result', help='internal: file to write results to')
+    options, args = parser.parse_args()
+
+    if options.run_app:
+        results = run_app(options.run_app, options.config, options.requests,
+                          options.warmup)
+        with open(options.result, 'w') as output:
+            json.dump(results, output)
+        sys.exit(0)
+
+    dataset_options = dataset.get_options(options)
+    del dataset_options['secret_key']
+    results = run(options.apps.split(','), options.requests, options.warmup,
+                  options.cache, dataset_options)
+    with open(options.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print_results(results)
+    if options.compare:
+        with open(options.compare) as old:
+            print_comparison(json.load(old), results, options.threshold)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Description {{{
+"""
+    imposter.benchmarks.dataset
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Generate a synthetic weblog database for benchmarks
+
+    Users, tags, posts and pages are inserted in bulk into the tables of
+    models.py, together with the published_posts projection and the tag
+    counts. The same options and seed always produce the same database,
+    apart from dates, which are relative to the current time.
+
+    usage: dataset.py [options] database_file
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from random import Random
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from database import Base
+from models import User, Tag, Status, Format, Post, Page, PublishedPost, \
+                   post_tags, published_post_tags, update_tag_counts
+from flaskjk import encrypt_password
+# }}}
+
+# password of all generated users
+PASSWORD = 'benchmark'
+
+# statuses drawn for posts, most of them public
+STATUS_CHOICES = [1, 2, 3, 3, 3, 3]
+
+# number of posts with a publication date in the future
+SCHEDULED_POSTS = 5
+
+# rows inserted per statement
+BATCH_SIZE = 1000
+
+WORDS = ('imposter weblog python flask werkzeug jinja sqlalchemy markup '
+         'post page tag feed archive summary content query cache index '
+         'database session render template request response').split()
+
+# Default options {{{
+DEFAULTS = dict(posts=1000, users=5, tags=100, tags_per_post=3, pages=10,
+                summary_size=200, content_size=2000, secret_key='CHANGE_THIS',
+                seed=0)
+# }}}
+
+# Helper functions {{{
+def text(random, size):
+    """Return reST markup and matching html of about size characters"""
+    paragraphs = []
+    length = 0
+    while length < size:
+        words = [random.choice(WORDS) for i in range(random.randint(20, 60))]
+        paragraph = ' '.join(words).capitalize() + '.'
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return ('\n\n'.join(paragraphs),
+            '\n'.join('<p>%s</p>' % paragraph for paragraph in paragraphs))
+
+def insert(conn, table, rows):
+    """Insert rows in batches of BATCH_SIZE"""
+    for start in range(0, len(rows), BATCH_SIZE):
+        conn.execute(table.insert(), rows[start:start + BATCH_SIZE])
+# }}}
+
+def generate(engine, posts=1000, users=5, tags=100, tags_per_post=3, pages=10,
+             summary_size=200, content_size=2000, secret_key='CHANGE_THIS',
+             seed=0):
+    """Fill an empty database, with the tables already created
+
+    Posts are named post-1 .. post-N, one minute apart with the last
+    SCHEDULED_POSTS in the future, and users user1 .. userN with PASSWORD.
+
+    :param tags_per_post: number of tags of every post, at most tags
+    :param summary_size: approximate number of characters of the summaries
+    :param content_size: approximate number of characters of the contents
+    :param secret_key: SECRET_KEY of the admin, to encrypt the passwords
+    :param seed: seed of the random generator
+    """
+    random = Random(seed)
+    now = datetime.now().replace(microsecond=0)
+    conn = engine.connect()
+    trans = conn.begin()
+    conn.execute(Status.__table__.insert(), [
+        dict(id=1, value='draft'), dict(id=2, value='private'),
+        dict(id=3, value='public')])
+    conn.execute(Format.__table__.insert(), [
+        dict(id=1, value='rest'), dict(id=2, value='markdown')])
+    password = encrypt_password(secret_key, PASSWORD)
+    insert(conn, User.__table__, [
+        dict(id=i, username='user%d' % i, password=password)
+        for i in range(1, users + 1)])
+    insert(conn, Tag.__table__, [
+        dict(id=i, value='tag%d' % i, count=0) for i in range(1, tags + 1)])
+
+    # a few variations of the texts are enough, generating them is slow
+    summaries = [text(random, summary_size) for i in range(10)]
+    contents = [text(random, content_size) for i in range(10)]
+
+    post_rows = []
+    tag_rows = []
+    published = []
+    published_tags = []
+    for i in range(1, posts + 1):
+        pubdate = now - timedelta(minutes=posts - SCHEDULED_POSTS - i)
+        status_id = random.choice(STATUS_CHOICES)
+        user_id = random.randint(1, users)
+        slug = 'post-%d' % i
+        summary, summary_html = random.choice(summaries)
+        content, content_html = random.choice(contents)
+        post_rows.append(dict(id=i, title='Post %d' % i, slug=slug,
+                              summary=summary, content=content,
+                              summary_html=summary_html,
+                              content_html=content_html,
+                              status_id=status_id, user_id=user_id,
+                              format_id=1, createdate=pubdate,
+                              pubdate=pubdate, lastmoddate=pubdate))
+        tag_ids = random.sample(range(1, tags + 1), tags_per_post)
+        tag_rows.extend(dict(post_id=i, tag_id=tag_id) for tag_id in tag_ids)
+        if status_id == 3:
+            published.append(dict(post_id=i, slug=slug, pubdate=pubdate,
+                                  year=pubdate.year, month=pubdate.month,
+                                  user_id=user_id))
+            published_tags.extend(dict(post_id=i, tag_id=tag_id,
+                                       pubdate=pubdate)
+                                  for tag_id in tag_ids)
+    insert(conn, Post.__table__, post_rows)
+    insert(conn, post_tags, tag_rows)
+    insert(conn, PublishedPost.__table__, published)
+    insert(conn, published_post_tags, published_tags)
+
+    content, content_html = random.choice(contents)
+    insert(conn, Page.__table__, [
+        dict(id=i, title='Page %d' % i, slug='page-%d' % i, content=content,
+             content_html=content_html, status_id=3, user_id=1, format_id=1,
+             createdate=now, pubdate=now, lastmoddate=now)
+        for i in range(1, pages + 1)])
+    trans.commit()
+    conn.close()
+
+    db_session = sessionmaker(bind=engine)()
+    update_tag_counts(db_session)
+    db_session.commit()
+    db_session.close()
+
+def create(filename, **options):
+    """Create SQLite database file filled by generate, replacing an existing
+    file"""
+    if os.path.exists(filename):
+        os.remove(filename)
+    engine = create_engine('sqlite:///%s' % filename)
+    Base.metadata.create_all(engine)
+    generate(engine, **options)
+    engine.dispose()
+
+def option_parser(usage):
+    """Return OptionParser with the options of generate"""
+    parser = OptionParser(usage=usage)
+    parser.add_option('--posts', type='int', help='number of posts')
+    parser.add_option('--users', type='int', help='number of users')
+    parser.add_option('--tags', type='int', help='number of tags')
+    parser.add_option('--tags-per-post', type='int',
+                      help='number of tags of every post')
+    parser.add_option('--pages', type='int', help='number of pages')
+    parser.add_option('--summary-size', type='int',
+                      help='characters of markup per summary')
+    parser.add_option('--content-size', type='int',
+                      help='characters of markup per post and page')
+    parser.add_option('--seed', type='int', help='random seed')
+    parser.add_option('--secret-key',
+                      help='SECRET_KEY of the admin, to encrypt passwords')
+    parser.set_defaults(**DEFAULTS)
+    return parser
+
+def get_options(options):
+    """Return dict of generate arguments from parsed options"""
+    return dict((key, getattr(options, key)) for key in DEFAULTS)
+
+#---------------------------------------------------------------------------
+# MAIN RUN LOOP
+if __name__ == '__main__':
+    parser = option_parser('usage: %prog [options] database_file')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('missing database file')
+    create(args[0], **get_options(options))
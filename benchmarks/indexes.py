@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Description {{{
+"""
+    imposter.benchmarks.indexes
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmark the queries of the hot read paths with and without the indexes
+    added by migration 007
+
+    A SQLite database is seeded with a configurable number of posts, the
+    queries are timed without the indexes, the indexes are created and the
+    queries are timed again.
+
+    usage: indexes.py [database file] [number of posts]
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from datetime import datetime
+from time import time
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import and_
+from database import Base
+from models import User, Tag, Status, Post, Page, PublishedPost, post_tags, tn
+from dataset import generate
+# }}}
+
+# indexes created by migrations/versions/007_Add_indexes.py
+INDEXES = ['posts_slug', 'posts_status_pubdate', 'posts_user_createdate',
+           'posts_lastmoddate', 'post_tags_post', 'post_tags_tag',
+           'tags_count', 'pages_status_pubdate', 'pages_user_createdate']
+
+NR_OF_USERS = 10
+NR_OF_TAGS = 500
+TAGS_PER_POST = 3
+RUNS = 20
+
+# Helper functions {{{
+def get_indexes():
+    """Return the Index objects of migration 007"""
+    names = [tn(name) for name in INDEXES]
+    return [index for table in Base.metadata.tables.values()
+            for index in table.indexes if index.name in names]
+
+def seed(engine, nr_of_posts):
+    """Fill an empty database with nr_of_posts posts"""
+    generate(engine, posts=nr_of_posts, users=NR_OF_USERS, tags=NR_OF_TAGS,
+             tags_per_post=TAGS_PER_POST, pages=20, summary_size=10,
+             content_size=10)
+
+def get_queries(db_session, nr_of_posts):
+    """Return list of (name, function) tuples running the benchmarked
+    queries, modelled after the ones in frontend.py, public_api.py and
+    admin.py"""
+    now = datetime.now()
+    public = and_(Post.id==PublishedPost.post_id,
+                  PublishedPost.pubdate <= now,
+                  Post.status_id==Status.id,
+                  Post.user_id==User.id)
+    posts_base = db_session.query(Post, Status, User).filter(public)
+    public_status = db_session.query(Status.id) \
+            .filter(Status.value=='public').scalar()
+    slug = 'post-%d' % (nr_of_posts / 2)
+
+    return [
+        ('show_post by slug', lambda:
+            posts_base.filter(PublishedPost.slug==slug).first()),
+        ('post by slug (posts table)', lambda:
+            db_session.query(Post).filter(Post.slug==slug).first()),
+        ('tags of 10 posts', lambda:
+            db_session.query(post_tags.c.tag_id).filter(
+                post_tags.c.post_id.in_(range(1, 11))).all()),
+        ('tag recount', lambda:
+            db_session.query(func.count(post_tags.c.post_id)).filter(
+                post_tags.c.tag_id==7).scalar()),
+        ('tag cloud', lambda:
+            db_session.query(Tag).filter(Tag.count>=1)
+                .order_by(Tag.count.desc())[0:100]),
+        ('admin posts list', lambda:
+            db_session.query(Post).filter(Post.user_id==1)
+                .order_by(Post.createdate.desc(), Post.id.desc())[0:10]),
+        ('public posts by status', lambda:
+            db_session.query(func.max(Post.pubdate)).filter(and_(
+                Post.status_id==public_status, Post.pubdate <= now))
+                .scalar()),
+        ('last modification', lambda:
+            db_session.query(func.max(Post.lastmoddate)).scalar()),
+        ('published pages', lambda:
+            db_session.query(Page).filter(and_(
+                Page.status_id==public_status, Page.pubdate <= now)).all()),
+        ]
+
+def run(db_session, queries):
+    """Return dict of name: (best, average) milliseconds per query"""
+    results = {}
+    for name, fun in queries:
+        timings = []
+        for i in range(RUNS):
+            start = time()
+            fun()
+            timings.append((time() - start) * 1000)
+            db_session.expunge_all()
+        results[name] = (min(timings), sum(timings) / len(timings))
+    return results
+# }}}
+
+def benchmark(filename, nr_of_posts):
+    """Seed database, run queries without and with the indexes"""
+    if os.path.exists(filename):
+        os.remove(filename)
+    engine = create_engine('sqlite:///%s' % filename)
+    Base.metadata.create_all(engine)
+    for index in get_indexes():
+        index.drop(engine)
+
+    print("Seeding %d posts ... " % nr_of_posts)
+    seed(engine, nr_of_posts)
+    engine.execute('ANALYZE')
+
+    db_session = sessionmaker(bind=engine)()
+    queries = get_queries(db_session, nr_of_posts)
+    before = run(db_session, queries)
+
+    for index in get_indexes():
+        index.create(engine)
+    engine.execute('ANALYZE')
+    after = run(db_session, queries)
+
+    print("%-30s %12s %12s %8s" % ('query (best of %d)' % RUNS,
+                                   'before (ms)', 'after (ms)', 'speedup'))
+    for name, fun in queries:
+        best_before = before[name][0]
+        best_after = after[name][0]
+        print("%-30s %12.3f %12.3f %7.1fx" % (name, best_before, best_after,
+                                              best_before / max(best_after,
+                                                                0.001)))
+
+#---------------------------------------------------------------------------
+# MAIN RUN LOOP
+if __name__ == '__main__':
+    filename = 'imposter-benchmark.db'
+    nr_of_posts = 100000
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    if len(sys.argv) > 2:
+        nr_of_posts = int(sys.argv[2])
+    benchmark(filename, nr_of_posts)
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+# Description {{{
+"""
+    imposter.cache
+    ~~~~~~~~~~~~~~
+
+    Simple caching for the Imposter weblog app
+
+    Cache entries are kept in a backend: in process memory (MemoryBackend),
+    in a directory shared by all processes (FileBackend) or nowhere at all
+    (NullBackend).
+
+    The admin and the frontend usually run in separate processes, so the admin
+    can't clear the frontend's caches directly. Instead, the admin touches a
+    stamp file after changing data and every cache compares the modification
+    time of that file with the one it saw last. The backend keeps the
+    modification time it was last cleared for, so a process starting with a
+    shared directory filled before the stamp was touched clears it as well.
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+from __future__ import with_statement
+from flask import current_app, request, make_response
+from collections import OrderedDict
+from functools import wraps
+from hashlib import md5
+from threading import Lock, current_thread
+from time import time
+
+import os
+import logging
+import cPickle as pickle
+# }}}
+
+log = logging.getLogger('imposter.cache')
+
+# backend key of the stamp the entries were stored for
+STAMP_KEY = '__stamp__'
+
+# Helper functions {{{
+def get_stamp(stamp_file):
+    """Return modification time of the stamp file, None if there is none"""
+    if stamp_file is None:
+        return None
+    try:
+        return os.path.getmtime(stamp_file)
+    except OSError:
+        return None
+
+def invalidate(stamp_file):
+    """Touch the stamp file so all caches using it will be cleared
+
+    Called after the changes are committed, so failing to touch the file is
+    logged instead of failing the request. The caches then expire entries
+    after their TTL only.
+    """
+    if stamp_file is None:
+        return
+    try:
+        with open(stamp_file, 'a'):
+            os.utime(stamp_file, None)
+    except (IOError, OSError):
+        log.exception('Could not touch cache stamp file %s' % stamp_file)
+
+def create_backend(name, size=None, path=None):
+    """Return cache backend by name
+
+    :param name: 'memory', 'filesystem' or None for no caching at all
+    :param size: maximum number of entries kept by the memory backend
+    :param path: directory used by the filesystem backend
+    """
+    if name is None:
+        return NullBackend()
+    if name == 'memory':
+        return MemoryBackend(size)
+    if name == 'filesystem':
+        return FileBackend(path)
+    raise ValueError('Unknown cache backend: %s' % name)
+# }}}
+
+# Backends {{{
+class NullBackend(object):
+    """Backend which doesn't store anything"""
+    def get(self, key):
+        return None
+
+    def set(self, key, entry):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+class MemoryBackend(object):
+    """Backend storing entries in process memory
+
+    If size is given, the least recently used entries are removed when more
+    than size entries are stored.
+    """
+    def __init__(self, size=None):
+        self.size = size
+        self.lock = Lock()
+        self.clear()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while self.size is not None and len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+
+class FileBackend(object):
+    """Backend storing pickled entries in a directory
+
+    The directory can be shared by multiple processes.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filename(self, key):
+        """Return path of the file used to store key"""
+        return os.path.join(self.path, md5(repr(key)).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self.filename(key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, entry):
+        # write to a temporary file first so readers never see half an entry,
+        # named after the process and the thread as both may write the key
+        filename = self.filename(key)
+        tmp_filename = '%s.%d.%d' % (filename, os.getpid(),
+                                     current_thread().ident)
+        try:
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            # not caching an entry is better than failing the request
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+
+    def delete(self, key):
+        try:
+            os.remove(self.filename(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for filename in os.listdir(self.path):
+            # leave the temporary files of other writers alone
+            if '.' in filename:
+                continue
+            try:
+                os.remove(os.path.join(self.path, filename))
+            except OSError:
+                pass
+# }}}
+
+# Classes {{{
+class TimedCache(object):
+    """Key/value store with entries expiring after a number of seconds
+
+    :param ttl: default number of seconds before an entry expires
+    :param stamp_file: path to the stamp file used for invalidation
+    :param backend: where to store the entries, defaults to MemoryBackend
+    :param get_expires: function returning a timestamp at which all entries
+                        stored now have to expire, or None
+
+    The number of lookups finding an entry and finding nothing are counted
+    in hits and misses.
+    """
+    def __init__(self, ttl, stamp_file=None, backend=None, get_expires=None):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stamp_file = stamp_file
+        self.stamp = None
+        if backend is None:
+            backend = MemoryBackend()
+        self.backend = backend
+        self.get_expires = get_expires
+        # a shared backend may hold entries from before the last change
+        self.check_stamp()
+
+    def check_stamp(self):
+        """Clear the cache if the stamp file was touched since the backend was
+        last cleared"""
+        stamp = get_stamp(self.stamp_file)
+        if stamp != self.stamp:
+            if self.backend.get(STAMP_KEY) != stamp:
+                self.clear()
+                self.backend.set(STAMP_KEY, stamp)
+            self.stamp = stamp
+
+    def get(self, key):
+        """Return value stored for key, None if missing or expired"""
+        self.check_stamp()
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires < time():
+            self.backend.delete(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Store value for key"""
+        if ttl is None:
+            ttl = self.ttl
+        expires = time() + ttl
+        if self.get_expires is not None:
+            expires = min(expires, self.get_expires() or expires)
+        self.backend.set(key, (expires, value))
+
+    def clear(self):
+        """Remove all entries"""
+        self.backend.clear()
+
+    def cached(self, key):
+        """Decorator caching the return value of a function without arguments"""
+        def decorator(fun):
+            @wraps(fun)
+            def decorated_function():
+                """Decorated function"""
+                value = self.get(key)
+                if value is None:
+                    value = fun()
+                    self.set(key, value)
+                return value
+            return decorated_function
+        return decorator
+
+    def cached_view(self, get_lastmod=None):
+        """Decorator caching the complete response of a view
+
+        Responses are cached by path and query string. Only successful
+        responses are cached. An ETag is generated from the response data,
+        and conditional requests are answered with 304 Not Modified.
+
+        :param get_lastmod: function returning the datetime (UTC) to use for
+                            the Last-Modified header, or None
+        """
+        def decorator(fun):
+            @wraps(fun)
+            def decorated_function(*args, **kwargs):
+                """Decorated function"""
+                key = (request.path, request.query_string)
+                entry = self.get(key)
+                if entry is None:
+                    response = make_response(fun(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    last_modified = None
+                    if get_lastmod is not None:
+                        last_modified = get_lastmod()
+                    entry = dict(data=response.data,
+                                 content_type=response.headers['Content-Type'],
+                                 etag=md5(response.data).hexdigest(),
+                                 last_modified=last_modified)
+                    self.set(key, entry)
+
+                response = current_app.response_class(entry['data'],
+                        headers=[('Content-Type', entry['content_type'])])
+                response.set_etag(entry['etag'])
+                if entry['last_modified'] is not None:
+                    response.last_modified = entry['last_modified']
+                return response.make_conditional(request)
+            return decorated_function
+        return decorator
+# }}}
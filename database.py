@@ -1,32 +1,382 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker, class_mapper
+from __future__ import with_statement
+from sqlalchemy import create_engine, event, exc, Column, DateTime
+from sqlalchemy.orm import scoped_session, sessionmaker, class_mapper, \
+                           ColumnProperty, Session
+from sqlalchemy.sql.expression import UpdateBase
+import sqlalchemy.orm
 from sqlalchemy.ext.declarative import declarative_base
+from itertools import cycle
+from threading import Lock
+from time import time
+
+import os
 
 Base = declarative_base()
 
+# engines by connection string, shared by all apps in the process
+engines = {}
+engines_lock = Lock()
+
+# statements setting the statement timeout in milliseconds, by dialect
+STATEMENT_TIMEOUT_SQL = {
+    'postgresql': 'SET statement_timeout = %d',
+    'mysql': 'SET SESSION max_execution_time = %d',
+    }
+
+class PoolStatistics(object):
+    """Counters of the connections handed out by the pool of an engine
+
+    Waiting is the time spent getting a connection from the pool, including
+    connecting to the database when the pool needs a new connection. It is
+    measured by wrapping _do_get of the pool, which SQLAlchemy keeps private,
+    so it stays 0 for pools without one.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        event.listen(engine, 'connect', self.on_connect)
+        event.listen(engine, 'checkout', self.on_checkout)
+        event.listen(engine, 'checkin', self.on_checkin)
+        # dispose replaces the pool, wrap the new one as well
+        event.listen(engine, 'engine_disposed', self.on_disposed)
+        self.time_pool(engine.pool)
+
+    def time_pool(self, pool):
+        """Measure the waiting of every checkout from pool"""
+        # every checkout passes _do_get of the pool, which blocks while the
+        # pool is exhausted
+        do_get = getattr(pool, '_do_get', None)
+        if do_get is None:
+            return
+        def timed_do_get():
+            start = time()
+            try:
+                return do_get()
+            finally:
+                self.add_wait(time() - start)
+        pool._do_get = timed_do_get
+
+    def on_disposed(self, engine):
+        self.time_pool(engine.pool)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+        with self.lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record,
+                    connection_proxy):
+        # never use a connection opened by the parent of a forked process
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError('Connection belongs to pid %d, '
+                                         'this is pid %d' %
+                                         (connection_record.info['pid'],
+                                          os.getpid()))
+        with self.lock:
+            self.checkouts += 1
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.checkins += 1
+
+    def add_wait(self, seconds):
+        with self.lock:
+            self.wait_time += seconds
+            self.max_wait_time = max(self.max_wait_time, seconds)
+
+    def get(self):
+        """Return dict of the counters and the current state of the pool
+
+        wait_time and max_wait_time are in seconds. The size of the pool and
+        its overflow are only known for pools keeping connections in a queue.
+        """
+        pool = self.engine.pool
+        with self.lock:
+            out = dict(connects=self.connects,
+                       checkouts=self.checkouts,
+                       checkins=self.checkins,
+                       checked_out=self.checkouts - self.checkins,
+                       wait_time=self.wait_time,
+                       max_wait_time=self.max_wait_time)
+        for key in ('size', 'overflow', 'checkedin'):
+            if hasattr(pool, key):
+                out[key] = getattr(pool, key)()
+        return out
+
+def db_options(config, prefix='DATABASE'):
+    """Return keyword arguments for DB from the replica and pool settings in
+    config
+
+    :param prefix: prefix of the config keys, for example 'PUBLIC_API_DATABASE'
+                   for PUBLIC_API_DATABASE_POOL_SIZE
+    """
+    return dict((key, config.get('%s_%s' % (prefix, key.upper())))
+                for key in ('replicas', 'replica_routing', 'pool_size',
+                            'max_overflow', 'pool_recycle', 'pool_pre_ping',
+                            'statement_timeout'))
+
+def get_engine(dbstring, pool_size=None, max_overflow=None, pool_recycle=None,
+               pool_pre_ping=False, statement_timeout=None):
+    """Return the engine of the process for dbstring, creating it if needed
+
+    Options which are None are left to SQLAlchemy, as not every pool accepts
+    them. The options of the first call for a dbstring are used.
+
+    :param pool_size: number of connections kept open
+    :param max_overflow: number of connections opened beyond pool_size when
+                         all are in use
+    :param pool_recycle: number of seconds after which connections are
+                         replaced
+    :param pool_pre_ping: test connections before handing them out
+    :param statement_timeout: number of seconds after which the database
+                              cancels a statement
+    """
+    with engines_lock:
+        if dbstring in engines:
+            return engines[dbstring]
+        kwargs = dict(pool_size=pool_size, max_overflow=max_overflow,
+                      pool_recycle=pool_recycle)
+        kwargs = dict((key, value) for key, value in kwargs.items()
+                      if value is not None)
+        if pool_pre_ping:
+            kwargs['pool_pre_ping'] = True
+        engine = create_engine(dbstring, convert_unicode=True, **kwargs)
+
+        if statement_timeout is not None:
+            sql = STATEMENT_TIMEOUT_SQL.get(engine.dialect.name)
+            if sql is None:
+                raise ValueError('Statement timeout not supported for %s' %
+                                 engine.dialect.name)
+            sql = sql % (statement_timeout * 1000)
+            @event.listens_for(engine, 'connect')
+            def set_statement_timeout(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute(sql)
+                cursor.close()
+                # the SET opened a transaction, commit it so the setting
+                # stays for the session instead of ending with a rollback
+                dbapi_connection.commit()
+
+        engine.statistics = PoolStatistics(engine)
+        engines[dbstring] = engine
+        return engine
+
+def pool_statistics():
+    """Return dict of the pool statistics of every engine, by dbstring"""
+    with engines_lock:
+        return dict((dbstring, engine.statistics.get())
+                    for dbstring, engine in engines.items())
+
+class RoundRobinRouter(object):
+    """Pick the replicas one after another"""
+    def __init__(self, engines):
+        self.engines = engines
+        self.next = cycle(engines).next
+        self.lock = Lock()
+
+    def __call__(self):
+        with self.lock:
+            return self.next()
+
+class LeastConnectionsRouter(object):
+    """Pick the replica with the fewest connections in use by this process"""
+    def __init__(self, engines):
+        self.engines = engines
+
+    def __call__(self):
+        return min(self.engines,
+                   key=lambda engine: engine.statistics.get()['checked_out'])
+
+# replica routers by name of the *_REPLICA_ROUTING setting
+ROUTERS = {
+    'round_robin': RoundRobinRouter,
+    'least_connections': LeastConnectionsRouter,
+    }
+
+class RoutingSession(Session):
+    """Session writing to the primary database and reading from a replica
+
+    A replica is picked by router for every transaction and used until the
+    transaction ends. Flushes and INSERT, UPDATE and DELETE statements always
+    go to the primary, and so does everything else when use_primary is set
+    or there are no replicas.
+
+    The engine of the primary database is passed as bind.
+
+    :param router: callable returning a replica engine, None without replicas
+    :param use_primary: read from the primary as well
+    """
+    def __init__(self, router=None, use_primary=False, **kwargs):
+        Session.__init__(self, **kwargs)
+        self.router = router
+        self.use_primary = use_primary
+        self.replica = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.router is None or self.use_primary or self._flushing or \
+               isinstance(clause, UpdateBase):
+            return self.bind
+        if self.replica is None:
+            self.replica = self.router()
+        return self.replica
+
+    def commit(self):
+        Session.commit(self)
+        self.replica = None
+
+    def rollback(self):
+        Session.rollback(self)
+        self.replica = None
+
+    def close(self):
+        Session.close(self)
+        self.replica = None
+
 class DB(object):
+    """Session factory for a database
+
+    Apps using the same dbstring share the engine and its connection pool,
+    see get_engine for the keyword arguments. Sessions read from the
+    replicas, if any, see RoutingSession.
+
+    :param replicas: list of connection strings of read-only copies of the
+                     database, using the same pool settings
+    :param replica_routing: 'round_robin' or 'least_connections'
+    """
     engine = None
     db_session = None
 
-    def __init__(self, dbstring):
-        self.engine = create_engine(dbstring, convert_unicode=True)
-        self.db_session = scoped_session(sessionmaker(autocommit=False,
-                                                 autoflush=False,
-                                                 bind=self.engine))
+    def __init__(self, dbstring, replicas=None, replica_routing=None,
+                 **options):
+        self.engine = get_engine(dbstring, **options)
+        self.router = None
+        if replicas:
+            routing = replica_routing or 'round_robin'
+            if routing not in ROUTERS:
+                raise ValueError('Unsupported replica routing: %s' % routing)
+            self.router = ROUTERS[routing]([get_engine(replica, **options)
+                                            for replica in replicas])
+        self.db_session = self.create_session()
+        self.primary_session = None
         Base.query = self.db_session.query_property()
 
-    def get_session(self):
-        return self.db_session
+    def create_session(self, use_primary=False):
+        return scoped_session(sessionmaker(class_=RoutingSession,
+                                           bind=self.engine,
+                                           router=self.router,
+                                           use_primary=use_primary,
+                                           autocommit=False,
+                                           autoflush=False))
+
+    def get_session(self, primary=False):
+        """Return the scoped session
+
+        :param primary: return a session using only the primary database, for
+                        code reading data it is about to change
+        """
+        if not primary:
+            return self.db_session
+        if self.primary_session is None:
+            self.primary_session = self.create_session(use_primary=True)
+        return self.primary_session
+
+    def get_engines(self):
+        """Return list of the primary engine and the replica engines"""
+        if self.router is None:
+            return [self.engine]
+        return [self.engine] + self.router.engines
+
+    def get_statistics(self):
+        """Return the statistics of the connection pool, see PoolStatistics"""
+        return self.engine.statistics.get()
+
+def eager_options(strategy, *attributes):
+    """Return query options to load the given relationships eagerly
+
+    :param strategy: 'joined', 'subquery', 'selectin' or None for lazy loading
+    :param attributes: relationships to load, for example Post.tags
+    """
+    if strategy is None:
+        return []
+    loader = getattr(sqlalchemy.orm, '%sload' % strategy, None)
+    if loader is None:
+        raise ValueError('Unsupported loading strategy: %s' % strategy)
+    return [loader(attribute) for attribute in attributes]
+
+class Serializer(object):
+    """Convert the public data of a model to dicts suitable for JSON
+
+    Everything needed is looked up once, from the __public_columns__ of the
+    model: DateTime columns are formatted with the date_format passed when
+    converting, so it can come from the config of the app, other columns
+    are passed as they are and relationships become sorted lists of the
+    unicode values of the related objects, in the same order as tag_values
+    lists them for rows.
+
+    Lists can be converted in bulk from row tuples of a query selecting
+    the columns attribute, without loading any model instances.
+    """
+    def __init__(self, model):
+        self.columns = []
+        self.relations = []
+        for attribute in model.__public_columns__:
+            if isinstance(attribute, ColumnProperty):
+                # deferred column
+                attribute = attribute.columns[0]
+            if isinstance(attribute, Column):
+                self.columns.append(attribute)
+            else:
+                self.relations.append(attribute.key)
+        self.fields = [(index, column.name, isinstance(column.type, DateTime))
+                       for index, column in enumerate(self.columns)]
+
+    def from_row(self, row, date_format, start=0):
+        """Return dict of the columns of a row tuple
+
+        :param date_format: strftime format of the DateTime columns
+        :param start: index of the first public column in the row
+        """
+        out = {}
+        for index, name, is_date in self.fields:
+            value = row[start + index]
+            if is_date and value is not None:
+                value = value.strftime(date_format)
+            out[name] = value
+        return out
+
+    def from_rows(self, rows, date_format, start=0):
+        """Return list of dicts of the columns of row tuples"""
+        return [self.from_row(row, date_format, start) for row in rows]
+
+    def dump(self, obj, date_format):
+        """Return dict of the public data of a model instance"""
+        out = self.from_row([getattr(obj, column.key)
+                             for column in self.columns], date_format)
+        for key in self.relations:
+            out[key] = sorted(unicode(related)
+                              for related in getattr(obj, key))
+        return out
 
 class ImposterBase(object):
-    """ Mixin class to provide additional generic functions for the sqlalchemy models """
+    """ Mixin class to provide additional generic functions for the sqlalchemy models
+
+    Models set their Serializer as __serializer__, see models.py.
+    """
 
     def to_dict(obj):
         """Return dict containing all object data"""
         return dict((col.name, unicode(getattr(obj, col.name)))
                     for col in class_mapper(obj.__class__).mapped_table.c)
 
-    def get_public_dict(obj):
-        """Return dict containing only public object data"""
-        return dict((col.name, unicode(getattr(obj, col.name)))
-                    for col in obj.__class__.__public_columns__)
+    def get_public_dict(obj, date_format):
+        """Return dict containing only public object data
+
+        :param date_format: strftime format of the dates
+        """
+        return obj.__serializer__.dump(obj, date_format)
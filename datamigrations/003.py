@@ -1,18 +1,31 @@
 from database import DB
-from sqlalchemy.sql import and_
-from models import User, Tag, Status, Format, Post, post_tags
+from sqlalchemy.sql import select, bindparam
+from models import Format, Post
 from flaskjk import markup_to_html
+from datamigrations import get_checkpoint, process_chunks
 
 def upgrade(app):
-    """ data migration to update the Tag.count fields """
+    """ data migration to fill the compiled html fields """
     db_session = DB(app.config['DATABASE']).get_session()
-    existing_posts = db_session.query(Post).all()
+    posts = Post.__table__
+    formats = Format.__table__
+    query = select([posts.c.id, formats.c.value, posts.c.summary,
+                    posts.c.content]).where(posts.c.format_id==formats.c.id)
+    update = posts.update().where(posts.c.id==bindparam('_id')).values(
+        summary_html=bindparam('_summary_html'),
+        content_html=bindparam('_content_html'))
 
-    for post in existing_posts:
-        post.summary_html = markup_to_html(post.format, post.summary)
-        post.content_html = markup_to_html(post.format, post.content)
+    def compile_rows(rows):
+        params = []
+        for row in rows:
+            format = Format(row.value)
+            params.append(dict(_id=row.id,
+                _summary_html=markup_to_html(format, row.summary),
+                _content_html=markup_to_html(format, row.content)))
+        db_session.execute(update, params)
 
-    db_session.commit()
+    process_chunks(db_session, '003 posts', query, posts.c.id, compile_rows,
+                   get_checkpoint(app))
 
 def downgrade(app):
     # column is dropped, no changes needed
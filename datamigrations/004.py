@@ -1,17 +1,28 @@
 from database import DB
-from sqlalchemy.sql import and_
+from sqlalchemy.sql import select, and_, func
 from models import User, Tag, Status, Format, Post, post_tags
+from datamigrations import get_checkpoint, process_chunks
 
 def upgrade(app):
     """ data migration to update the Tag.count fields """
     db_session = DB(app.config['DATABASE']).get_session()
-    existing_tags = db_session.query(Tag).all()
+    tags = Tag.__table__
+    posts = Post.__table__
+    status = Status.__table__
 
-    for tag in existing_tags:
-        tag.count = db_session.query(Post, Status).filter(and_(Post.status_id==Status.id,
-            Status.value=='public',
-            )).filter(Post.tags.contains(tag)).count()
-    db_session.commit()
+    # count a chunk of tags at once using a correlated subquery
+    count = select([func.count(post_tags.c.post_id)]).where(and_(
+        post_tags.c.tag_id==tags.c.id,
+        post_tags.c.post_id==posts.c.id,
+        posts.c.status_id==status.c.id,
+        status.c.value=='public')).as_scalar()
+
+    def count_rows(rows):
+        db_session.execute(tags.update().values(count=count).where(
+            tags.c.id.in_([row.id for row in rows])))
+
+    process_chunks(db_session, '004 tags', select([tags.c.id]), tags.c.id,
+                   count_rows, get_checkpoint(app))
 
 def downgrade(app):
     # column is dropped, no changes needed
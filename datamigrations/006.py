@@ -0,0 +1,20 @@
+from database import DB
+from models import Post, refresh_published_post, update_tag_counts
+from datamigrations import get_checkpoint, process_chunks
+
+def upgrade(app):
+    """ data migration to fill the published_posts tables """
+    db_session = DB(app.config['DATABASE']).get_session()
+
+    def refresh_posts(posts):
+        for post in posts:
+            refresh_published_post(db_session, post)
+
+    process_chunks(db_session, '006 posts', db_session.query(Post), Post.id,
+                   refresh_posts, get_checkpoint(app))
+    update_tag_counts(db_session)
+    db_session.commit()
+
+def downgrade(app):
+    # tables are dropped, no changes needed
+    pass
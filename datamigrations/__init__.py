@@ -1,7 +1,145 @@
+from __future__ import with_statement
+from sqlalchemy.orm import Query
+from sqlalchemy.sql import select, func
+from time import time
+
+import os
+import json
+
+# number of rows processed per transaction
+CHUNK_SIZE = 500
+
+class Checkpoint(object):
+    """Progress of a long running job, saved to a JSON file on every change
+
+    If the file exists when the Checkpoint is created, the job was
+    interrupted and resumed is True. Without a filename, progress is only
+    kept in memory.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.data = {}
+        self.resumed = self.load()
+
+    def load(self):
+        """Read the saved progress, return False if there is none"""
+        if self.filename is None:
+            return False
+        try:
+            with open(self.filename) as f:
+                self.data = json.load(f)
+            return True
+        except IOError:
+            return False
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def update(self, values):
+        """Set several keys at once, saved together"""
+        # the file may be shared with other Checkpoint objects
+        self.load()
+        self.data.update(values)
+        self.save()
+
+    def save(self):
+        if self.filename is None:
+            return
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write to a temporary file first, a crash must not corrupt it
+        tmp_filename = '%s.tmp' % self.filename
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.data, f)
+        os.rename(tmp_filename, self.filename)
+
+    def remove(self):
+        """Forget all progress, the job is done"""
+        self.data = {}
+        self.resumed = False
+        if self.filename is not None and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+def get_checkpoint(app):
+    """Return Checkpoint of the data migrations"""
+    return Checkpoint(app.config.get('MIGRATION_CHECKPOINT_FILE'))
+
+def iter_chunks(db_session, query, id_column, chunk_size=CHUNK_SIZE,
+                last_id=0):
+    """Yield lists of rows of a query, ordered by id_column
+
+    Every chunk is fetched by a separate query seeking past the last id of
+    the previous chunk, so only chunk_size rows are held in memory.
+
+    :param query: ORM Query or select statement
+    :param id_column: unique integer column, its key has to be an attribute
+                      of the rows
+    """
+    while True:
+        if isinstance(query, Query):
+            rows = query.filter(id_column > last_id).order_by(id_column) \
+                    .limit(chunk_size).all()
+        else:
+            rows = db_session.execute(query.where(id_column > last_id)
+                                      .order_by(id_column)
+                                      .limit(chunk_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = getattr(rows[-1], id_column.key)
+
+def count_rows(db_session, query, id_column, last_id=0):
+    """Return number of rows of a query with an id above last_id"""
+    if isinstance(query, Query):
+        return query.filter(id_column > last_id).count()
+    return db_session.execute(select([func.count()]).select_from(
+        query.where(id_column > last_id).alias())).scalar()
+
+def process_chunks(db_session, name, query, id_column, fun, checkpoint,
+                   chunk_size=CHUNK_SIZE):
+    """Call fun with every chunk of rows of a query, committing after each
+
+    The id of the last row of every committed chunk is stored in checkpoint
+    under name, so a resumed run continues with the next chunk. Progress and
+    rows/s are printed after every chunk. Returns number of rows processed.
+
+    :param query: ORM Query or select statement, see iter_chunks
+    :param fun: function taking a list of rows
+    """
+    last_id = checkpoint.get(name, 0)
+    total = count_rows(db_session, query, id_column, last_id)
+    done = 0
+    start = time()
+    for rows in iter_chunks(db_session, query, id_column, chunk_size,
+                            last_id):
+        fun(rows)
+        db_session.commit()
+        checkpoint.set(name, getattr(rows[-1], id_column.key))
+        if isinstance(query, Query):
+            db_session.expunge_all()
+        done += len(rows)
+        print "%s: %d/%d rows, %.1f rows/s" % (name, done, total,
+                done / max(time() - start, 0.001))
+    return done
+
 def run_upgrade_scripts(app, from_version, to_version):
+    checkpoint = get_checkpoint(app)
+    if checkpoint.resumed:
+        # the schema is upgraded already, finish the interrupted scripts
+        from_version = checkpoint.get('version', from_version)
+        to_version = max(to_version, checkpoint.get('to_version', to_version))
+        print "Resuming data upgrade at version %d" % from_version
+    checkpoint.update(dict(version=from_version, to_version=to_version))
+
     for script_id in range(from_version, to_version):
+        checkpoint.set('version', script_id)
         script_name = '%03d' % (script_id + 1)
         run_upgrade_script(app, script_name)
+    checkpoint.remove()
 
 def run_upgrade_script(app, script_name):
     try:
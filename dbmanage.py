@@ -18,11 +18,15 @@
 
 from flask import Flask
 from migrate.versioning.api import version_control, upgrade, downgrade, db_version, version
-from sqlalchemy.sql import and_
-from models import User, Tag, Status, Format, Post, post_tags
+from sqlalchemy.sql import and_, select, bindparam
+from models import User, Tag, Status, Format, Post, Page, RenderedMarkup, \
+                   post_tags, rebuild_published_posts, update_tag_counts
 from database import DB
-from flaskjk import encrypt_password, slugify
+from cache import invalidate
+from flaskjk import encrypt_password, slugify, markup_to_html, multi_replace
 from datetime import datetime
+from multiprocessing import Pool
+from datamigrations import Checkpoint, process_chunks
 
 import sys
 import getpass
@@ -116,10 +120,84 @@ This is just a sample post to show Imposter works.
     p1.status = s3
     p1.user = u
     p1.tags = [t1, t2]
-    p1.compile()
+    p1.compile(db_session)
     db_session.add(p1)
+    db_session.flush()
+    rebuild_published_posts(db_session)
+    update_tag_counts(db_session)
     db_session.commit()
 
+def backfill_published_posts():
+    """Rebuild the published_posts tables from the posts table"""
+    db_session = DB(db).get_session()
+    print("Rebuilding published posts ... ")
+    rebuild_published_posts(db_session)
+    update_tag_counts(db_session)
+    db_session.commit()
+    print("Done!")
+
+def compile_row(args):
+    """Convert markup of a Post or Page row to html in a worker process
+
+    :param args: (id, format value, list of markup texts, replacements)
+    :returns: (id, list of html texts)
+    """
+    id, format_value, texts, repl = args
+    format = Format(format_value)
+    html = []
+    for text in texts:
+        if text is not None and repl is not None:
+            text = multi_replace(text, repl)
+        html.append(markup_to_html(format, text))
+    return (id, html)
+
+def recompile(processes=None):
+    """Regenerate the html of all posts and pages
+
+    Rows are compiled in chunks by a pool of worker processes, and every
+    chunk is committed separately. The id of the last committed row is kept
+    in a checkpoint file, so an interrupted run continues where it stopped.
+    """
+    # start the workers before opening any database connections
+    pool = Pool(processes)
+    db_session = DB(db).get_session()
+    checkpoint = Checkpoint(app.config['RECOMPILE_CHECKPOINT_FILE'])
+    if checkpoint.resumed:
+        print("Resuming interrupted recompile ... ")
+    else:
+        # the markup converters may have changed, so forget all cached html
+        db_session.execute(RenderedMarkup.__table__.delete())
+        db_session.commit()
+
+    formats = Format.__table__
+    for table, columns in ((Post.__table__, ['summary', 'content']),
+                           (Page.__table__, ['content'])):
+        query = select([table.c.id, formats.c.value] +
+                       [table.c[column] for column in columns]) \
+                .where(table.c.format_id==formats.c.id)
+        update = table.update().where(table.c.id==bindparam('_id')).values(
+            **dict(('%s_html' % column, bindparam('_%s' % column))
+                   for column in columns))
+
+        def compile_rows(rows):
+            tasks = [(row[0], row[1], list(row[2:]), app.config['REPL_TAGS'])
+                     for row in rows]
+            params = []
+            for id, html in pool.map(compile_row, tasks):
+                param = dict(zip(['_%s' % column for column in columns], html))
+                param['_id'] = id
+                params.append(param)
+            db_session.execute(update, params)
+
+        process_chunks(db_session, table.name, query, table.c.id,
+                       compile_rows, checkpoint)
+
+    pool.close()
+    pool.join()
+    checkpoint.remove()
+    invalidate(app.config['CACHE_STAMP_FILE'])
+    print("Done!")
+
 def install_db():
     """Initialize new Imposter database"""
     vc_db()
@@ -128,7 +206,7 @@ def install_db():
 
 def usage():
     """show dbmanage.py usage"""
-    print 'usage: dbmanage.py install|upgrade|downgrade version'
+    print 'usage: dbmanage.py install|upgrade|downgrade version|backfill|recompile [processes]'
 
 #---------------------------------------------------------------------------
 # MAIN RUN LOOP
@@ -143,6 +221,13 @@ if __name__ == '__main__':
         upgrade_db()
     elif sys.argv[1] == 'downgrade' and len(sys.argv) == 3:
         downgrade_db(sys.argv[2])
+    elif sys.argv[1] == 'backfill':
+        backfill_published_posts()
+    elif sys.argv[1] == 'recompile' and len(sys.argv) <= 3:
+        processes = None
+        if len(sys.argv) == 3:
+            processes = int(sys.argv[2])
+        recompile(processes)
     else:
         usage()
         sys.exit(1)
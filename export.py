@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Description {{{
+"""
+    imposter.export
+    ~~~~~~~~~~~~~~~
+
+    Export the frontend of the Imposter weblog app to static files
+
+    Every post, page, post list, archive and feed is rendered through the
+    frontend application and written to a directory tree which can be served
+    by any webserver. Directory URLs such as the feeds are written to
+    index.html in that directory. Uploads are not exported, point the
+    webserver to UPLOAD_PATH instead.
+
+    A manifest with a signature of the data behind every URL is kept in the
+    export directory. Subsequent exports only render the URLs whose
+    signature changed, and remove the files of URLs which disappeared.
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+from __future__ import with_statement
+from flask import url_for
+from hashlib import md5
+from multiprocessing import Pool
+from models import User, Tag, Post, Page, post_tags
+from frontend import app, db_session, filter_public, pages_base
+
+import os
+import sys
+import json
+# }}}
+
+MANIFEST = '.imposter-export.json'
+
+# Helper functions {{{
+def signature(*data):
+    """Return signature of the given data"""
+    return md5(repr(data)).hexdigest()
+
+def nr_of_pages(entries):
+    """Return number of list pages needed to show the given entries"""
+    per_page = app.config['ENTRIES_PER_PAGE']
+    return max(1, (len(entries) + per_page - 1) / per_page)
+
+def list_targets(entries, sidebar, endpoint, index=False, **kwargs):
+    """Return (url, signature) tuples for a paginated post list
+
+    :param entries: list of (id, lastmoddate) tuples of the listed posts
+    :param sidebar: signature of the data shown on every page
+    :param endpoint: endpoint of the paginated list, the name of its view
+    :param index: whether the view also has a route without page number
+                  showing the first page, like 'show_postlist_by_year_index'
+    """
+    per_page = app.config['ENTRIES_PER_PAGE']
+    pages = nr_of_pages(entries)
+    targets = []
+    for page in range(1, pages + 1):
+        chunk = entries[(page - 1) * per_page:page * per_page]
+        sig = signature(sidebar, pages, chunk)
+        targets.append((url_for(endpoint, page=page, **kwargs), sig))
+        if page == 1 and index:
+            targets.append((url_for(endpoint, **kwargs), sig))
+    return targets
+
+def get_targets():
+    """Return list of (url, signature) tuples for everything to export"""
+    posts = db_session.query(Post.id, Post.slug, Post.pubdate,
+                             Post.lastmoddate, User.username) \
+            .filter(filter_public()) \
+            .order_by(Post.pubdate.desc()).all()
+    pages = [(page.id, page.slug, page.lastmoddate)
+             for page, status, user in pages_base()]
+    tags = db_session.query(Tag.id, Tag.value, Tag.count) \
+            .order_by(Tag.id).all()
+    tag_values = dict((tag.id, tag.value) for tag in tags)
+    post_tag_ids = {}
+    for post_id, tag_id in db_session.query(post_tags.c.post_id,
+                                            post_tags.c.tag_id):
+        post_tag_ids.setdefault(post_id, []).append(tag_id)
+
+    # the sidebar is shown on every page, so if it changes, everything changes
+    sidebar = signature(pages, posts[:10], tags)
+
+    targets = []
+    by_year = {}
+    by_month = {}
+    by_tag = {}
+    by_user = {}
+    for post in posts:
+        entry = (post.id, post.lastmoddate)
+        tag_ids = post_tag_ids.get(post.id, [])
+        year = post.pubdate.year
+        month = '%02d' % post.pubdate.month
+        targets.append((url_for('show_post', slug=post.slug, year=year,
+                                month=month,
+                                day='%02d' % post.pubdate.day),
+                        signature(sidebar, entry, tag_ids)))
+        by_year.setdefault(year, []).append(entry)
+        by_month.setdefault((year, month), []).append(entry)
+        by_user.setdefault(post.username, []).append(entry)
+        for tag_id in tag_ids:
+            by_tag.setdefault(tag_values[tag_id], []).append(entry)
+
+    for page_id, slug, lastmoddate in pages:
+        targets.append((url_for('show_page', slug=slug),
+                        signature(sidebar, page_id, lastmoddate)))
+
+    entries = [(post.id, post.lastmoddate) for post in posts]
+    targets.append((url_for('show_index'), signature(sidebar, entries[:10])))
+    feed = signature(entries[:app.config['FEEDITEMS']], post_tag_ids)
+    targets.append((url_for('show_rss'), feed))
+    targets.append((url_for('show_atom'), feed))
+    targets.extend(list_targets(entries, sidebar, 'show_postlist'))
+    for year, year_entries in by_year.items():
+        targets.extend(list_targets(year_entries, sidebar,
+                                    'show_postlist_by_year',
+                                    index=True,
+                                    year=year))
+    for (year, month), month_entries in by_month.items():
+        targets.extend(list_targets(month_entries, sidebar,
+                                    'show_postlist_by_month',
+                                    index=True,
+                                    year=year, month=month))
+    for tag, tag_entries in by_tag.items():
+        targets.extend(list_targets(tag_entries, sidebar,
+                                    'show_postlist_by_tag',
+                                    index=True,
+                                    tag=tag))
+    for username, user_entries in by_user.items():
+        targets.extend(list_targets(user_entries, sidebar,
+                                    'show_postlist_by_username',
+                                    username=username))
+
+    static_path = os.path.join(app.root_path, 'templates', 'frontend',
+                               app.config['THEME'], 'static')
+    for dirpath, dirnames, filenames in os.walk(static_path):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            stat = os.stat(path)
+            relpath = os.path.relpath(path, static_path).replace(os.sep, '/')
+            targets.append((url_for('static_files', filename=relpath),
+                            signature(stat.st_mtime, stat.st_size)))
+
+    return targets
+
+def get_filename(directory, url):
+    """Return the file to write the given URL to"""
+    path = url.lstrip('/')
+    if path == '' or path.endswith('/'):
+        path += 'index.html'
+    return os.path.join(directory, *path.split('/'))
+
+def load_manifest(directory):
+    """Return dict of url: signature pairs of the previous export"""
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+def save_manifest(directory, manifest):
+    """Save dict of url: signature pairs of this export"""
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+# }}}
+
+# Worker functions {{{
+def export_url(args):
+    """Render URL and write it to the export directory
+
+    Returns (url, status code) tuple.
+    """
+    url, directory = args
+    response = app.test_client().get(url)
+    if response.status_code == 200:
+        filename = get_filename(directory, url)
+        if not os.path.isdir(os.path.dirname(filename)):
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:
+                # another worker created it in the mean time
+                pass
+        with open(filename, 'wb') as f:
+            f.write(response.data)
+    return (url, response.status_code)
+# }}}
+
+def export(directory, processes=None):
+    """Export the frontend to directory, rendering in parallel"""
+    with app.test_request_context():
+        targets = get_targets()
+
+    # the workers open their own database connections
+    db_session.remove()
+    db_session().bind.dispose()
+
+    old_manifest = load_manifest(directory)
+    new_manifest = dict(targets)
+    todo = [(url, directory) for url, sig in targets
+            if old_manifest.get(url) != sig]
+
+    print("Exporting %d of %d URLs ... " % (len(todo), len(targets)))
+    pool = Pool(processes)
+    for url, status_code in pool.imap_unordered(export_url, todo, 16):
+        if status_code != 200:
+            print("ERROR: %s returned %d" % (url, status_code))
+            del new_manifest[url]
+    pool.close()
+    pool.join()
+
+    for url in old_manifest:
+        if url not in new_manifest:
+            try:
+                os.remove(get_filename(directory, url))
+            except OSError:
+                pass
+
+    save_manifest(directory, new_manifest)
+    print("Done!")
+
+def usage():
+    """show export.py usage"""
+    print 'usage: export.py directory [processes]'
+
+#---------------------------------------------------------------------------
+# MAIN RUN LOOP
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        usage()
+        sys.exit(1)
+
+    processes = None
+    if len(sys.argv) == 3:
+        processes = int(sys.argv[2])
+
+    if not os.path.isdir(sys.argv[1]):
+        os.makedirs(sys.argv[1])
+    export(sys.argv[1], processes)
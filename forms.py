@@ -15,51 +15,141 @@
 from flaskext.wtf import Form, TextField, PasswordField, DateTimeField, SelectField, TextAreaField, FieldList, Required
 from wtforms.fields import Field
 from wtforms.widgets import TextInput
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.sql import select
 from models import Format, Status, Tag
+from lookups import lookups
 # }}}
 
 # Helper functions {{{
 def get_format(value):
     """Retrieve Format object based on given String"""
-    query = Format.query.filter(Format.value==value)
-    return query.one()
+    return lookups.get(Format.query.session, Format, value)
 
 def get_status(value):
     """Retrieve Status object based on given String"""
-    query = Status.query.filter(Status.value==value)
-    return query.one()
+    return lookups.get(Status.query.session, Status, value)
 
-def get_tag(value):
-    """Retrieve Tag object based on given String
+def insert_tags(db_session, rows):
+    """Insert Tag rows in a savepoint of the current transaction
 
-    If no such Tag object exists, return a new Tag object.
+    Returns False if one of the tags exists already. SQLite locks the whole
+    database for writing, so no concurrent insert can get in between there,
+    and the savepoint, which pysqlite doesn't handle, is skipped.
     """
-    tag = Tag.query.filter(Tag.value==value).first()
-    if tag is None:
-        return Tag(value)
-    return tag
+    insert = Tag.__table__.insert()
+    if db_session.get_bind(clause=insert).dialect.name == 'sqlite':
+        db_session.execute(insert, rows)
+        return True
+    savepoint = db_session.begin_nested()
+    try:
+        db_session.execute(insert, rows)
+        savepoint.commit()
+        return True
+    except IntegrityError:
+        savepoint.rollback()
+        return False
+
+def create_tags(db_session, values):
+    """Insert Tags for the given Strings, ignoring those which exist
+
+    The tags are inserted in the transaction saving the post, so they are
+    gone again if the save fails. A concurrent request inserting the same tag
+    only makes this insert fail, not the transaction. All tags are inserted
+    in one statement; if that fails they are inserted one by one, skipping
+    the ones which exist.
+    """
+    rows = [dict(value=value, count=0) for value in values]
+    if not insert_tags(db_session, rows):
+        for row in rows:
+            insert_tags(db_session, [row])
+
+def load_tags(db_session, values):
+    """Return Tags for the given Strings committed by other transactions
+
+    The snapshot of the current transaction may not include them, so they are
+    read on a separate connection and added to the session as they are.
+    """
+    tags = Tag.__table__
+    conn = db_session.get_bind(clause=tags.insert()).connect()
+    try:
+        rows = conn.execute(select([tags]).where(tags.c.value.in_(values))) \
+                .fetchall()
+    finally:
+        conn.close()
+    result = []
+    for row in rows:
+        tag = Tag(row.value)
+        tag.id = row.id
+        tag.count = row.count
+        make_transient_to_detached(tag)
+        db_session.add(tag)
+        result.append(tag)
+    return result
+
+def get_tags(values):
+    """Retrieve Tag objects based on given Strings
+
+    Existing tags are retrieved with a single query, missing ones are
+    created in the current transaction. Call this after compiling the post.
+    """
+    db_session = Tag.query.session
+    values = [value for value in values if value]
+    unique_values = list(set(values))
+    if not unique_values:
+        return []
+    tags = Tag.query.filter(Tag.value.in_(unique_values)).all()
+    if len(tags) < len(unique_values):
+        existing = set(tag.value for tag in tags)
+        create_tags(db_session, [value for value in unique_values
+                                 if value not in existing])
+        tags = Tag.query.filter(Tag.value.in_(unique_values)).all()
+    if len(tags) < len(unique_values):
+        existing = set(tag.value for tag in tags)
+        tags.extend(load_tags(db_session, [value for value in unique_values
+                                           if value not in existing]))
+
+    tags_by_value = dict((tag.value, tag) for tag in tags)
+    result = []
+    for value in values:
+        if tags_by_value[value] not in result:
+            result.append(tags_by_value[value])
+    return result
 # }}}
 
 # Classes {{{
 class TagListField(Field):
-    """Custom TagListField for editing tags"""
+    """Custom TagListField for editing tags
+
+    Submitted tags are kept as Strings. The view turns them into Tag objects
+    with get_tags once the form is valid, so a rejected form doesn't create
+    any tags.
+    """
     widget = TextInput()
 
     def _value(self):
         if self.data:
             tags = []
             for item in self.data:
-                tags.append(item.value)
+                if isinstance(item, Tag):
+                    item = item.value
+                tags.append(item)
             return u', '.join(tags)
         else:
             return u''
 
     def process_formdata(self, valuelist):
         if valuelist:
-            self.data = [get_tag(x.strip()) for x in valuelist[0].split(',')]
+            self.data = [x.strip() for x in valuelist[0].split(',')
+                         if x.strip()]
         else:
             self.data = []
 
+    def populate_obj(self, obj, name):
+        """Leave the tags to the view, see get_tags"""
+        pass
+
 class FormatField(SelectField):
     """A SelectField for picking a Format"""
     def populate_obj(self, obj, name):
@@ -16,56 +16,142 @@
 # Imports {{{
 from flask import Flask, abort
 from datetime import date, datetime
-from models import User, Tag, Status, Post, Page
+from models import User, Tag, Status, Post, Page, PublishedPost, \
+                   published_post_tags, render_markup
 from sqlalchemy.sql import and_, func
-
-from database import DB
-from flaskjk import Viewer, Paginator, summarize, markup_to_html
+from sqlalchemy.orm import undefer
+
+from database import DB, db_options, eager_options
+from cache import TimedCache, create_backend
+from time import mktime
+from flaskjk import Viewer, summarize
+from pagination import KeysetPaginator
+from lookups import lookups
+from profiling import Profiler
+from metrics import Metrics, registry
 # }}}
 
 # Initialization {{{
 app = Flask(__name__, static_path=None)
 app.config.from_pyfile('config_frontend.py')
 app.config.from_envvar('IMPOSTER_FRONTEND_CONFIG', silent=True)
-db_session = DB(app.config['DATABASE']).get_session()
+db = DB(app.config['DATABASE'], **db_options(app.config))
+db_session = db.get_session()
 viewer = Viewer(app, 'frontend', app.config['UPLOAD_PATH'])
+profiler = Profiler(app, db.get_engines(), viewer)
+metrics = Metrics(app, 'frontend', app.config['PREFIX'])
 # }}}
 
 # Shortcut functions {{{
 def filter_public():
-    """Make sure we only can retrieve Post objects marked as public"""
-    return and_(Post.status_id==Status.id,
-                Status.value=='public',
-                Post.user_id==User.id,
-                Post.pubdate <= datetime.now()
+    """Make sure we only can retrieve Post objects which are published"""
+    return and_(Post.id==PublishedPost.post_id,
+                PublishedPost.pubdate <= datetime.now(),
+                Post.status_id==Status.id,
+                Post.user_id==User.id
                )
 
 def posts_base():
     """Base query to make sure we get only published posts"""
     return db_session.query(Post, Status, User).filter(filter_public())
 
-def get_posts(p_filter=None, p_order=None):
+def post_options(*columns):
+    """Query options to load what the templates use
+
+    Status and User are selected by posts_base already, so only the tags
+    need to be loaded eagerly. The large text columns of Post are deferred,
+    only the given ones are loaded by the query itself.
+
+    :param columns: deferred columns the template shows, like Post.content_html
+    """
+    return eager_options(app.config['EAGER_LOADING'], Post.tags) + \
+            [undefer(column) for column in columns]
+
+def list_columns():
+    """Return the deferred Post columns shown in post lists and feeds"""
+    if app.config['SUMMARIES']:
+        return [Post.summary_html]
+    return [Post.content_html]
+
+def get_posts(p_filter=None, p_order=None, columns=()):
     """Shortcut function to get a query result filtered by given filter,
     ordered by given order
 
     :param p_filter: SQLAlchemy filter statement
     :param p_order: SQLAlchemy p_order statement
+    :param columns: deferred columns to load, see post_options
     """
-    ret = posts_base()
+    ret = posts_base().options(*post_options(*columns))
     if p_filter is not None:
         ret = ret.filter(p_filter)
     if p_order is not None:
         ret = ret.order_by(p_order)
     return ret
 
+def get_paginator(p_filter, page, endpoint, **kwargs):
+    """Return KeysetPaginator for published posts
+
+    :param p_filter: SQLAlchemy filter statement on PublishedPost and
+                     published_post_tags only, so the posts can be counted
+                     without touching the posts table
+    :param page: page number
+    :param endpoint: endpoint of the paginated view
+    :param kwargs: additional arguments for the endpoint
+    """
+    posts = posts_base()
+    count_query = db_session.query(PublishedPost.post_id) \
+            .filter(PublishedPost.pubdate <= datetime.now())
+    if p_filter is not None:
+        posts = posts.filter(p_filter)
+        count_query = count_query.filter(p_filter)
+    return KeysetPaginator(posts, app.config['ENTRIES_PER_PAGE'], page,
+                           endpoint, PublishedPost.pubdate,
+                           PublishedPost.post_id, count_query=count_query,
+                           count_cache=query_cache,
+                           options=post_options(*list_columns()),
+                           **kwargs)
+
+def public_status_id():
+    """Return id of the 'public' Status"""
+    return lookups.get_id(db_session, Status, 'public')
+
 def pages_base():
     """Base query to make sure we get only published pages"""
     return db_session.query(Page, Status, User) \
-            .filter(and_(Page.status_id==Status.id,
-                         Status.value=='public',
-                         Page.pubdate <= datetime.now()
+            .filter(and_(Page.status_id==public_status_id(),
+                         Page.pubdate <= datetime.now(),
+                         Page.status_id==Status.id,
+                         Page.user_id==User.id
                         ))
 
+def next_publication():
+    """Return timestamp of the first scheduled post or page publication
+
+    Cached data has to expire at that moment, otherwise the post or page
+    would not show up until the cache is cleared. Returns None if nothing
+    is scheduled.
+    """
+    now = datetime.now()
+    pubdates = [
+        db_session.query(func.min(PublishedPost.pubdate)).filter(
+            PublishedPost.pubdate > now).scalar(),
+        db_session.query(func.min(Page.pubdate)).filter(
+            and_(Page.status_id==public_status_id(),
+                 Page.pubdate > now)).scalar(),
+        ]
+    pubdates = [pubdate for pubdate in pubdates if pubdate is not None]
+    if not pubdates:
+        return None
+    return mktime(min(pubdates).timetuple())
+
+def last_modification():
+    """Return UTC datetime of the last modification of a published post"""
+    lastmoddate = db_session.query(func.max(Post.lastmoddate)) \
+            .filter(filter_public()).scalar()
+    if lastmoddate is None:
+        return None
+    return datetime.utcfromtimestamp(mktime(lastmoddate.timetuple()))
+
 @app.after_request
 def shutdown_session(response):
     """End session, close database"""
@@ -73,26 +159,63 @@ def shutdown_session(response):
     return response
 # }}}
 
-# Context Processors {{{
-@app.context_processor
-def inject_pages():
-    """Add pages base query to template context"""
-    return dict(pages=pages_base())
+# Caches {{{
+# data which is the same for every visitor, such as the sidebar contents
+query_cache = TimedCache(app.config['CACHE_TTL'], app.config['CACHE_STAMP_FILE'],
+                         get_expires=next_publication)
 
-@app.context_processor
-def inject_recent_posts():
-    """Add most recent post list to template context"""
-    p_order = Post.pubdate.desc()
-    recent_posts = get_posts(None, p_order)[0:10]
-    return dict(recent_posts=recent_posts)
+# complete responses of the views
+page_cache = TimedCache(app.config['CACHE_TTL'], app.config['CACHE_STAMP_FILE'],
+                        create_backend(app.config['PAGE_CACHE_BACKEND'],
+                                       app.config['PAGE_CACHE_SIZE'],
+                                       app.config['PAGE_CACHE_DIR']),
+                        get_expires=next_publication)
 
-@app.context_processor
-def inject_tag_cloud():
-    """Add tagcloud to template context."""
+registry.add_cache('frontend_query', query_cache)
+registry.add_cache('frontend_page', page_cache)
+# }}}
+
+# Context Processors {{{
+# The sidebar data is the same for every visitor, so it is computed once and
+# kept in query_cache until it expires or the admin changes data. The session
+# is removed after every request, so the cache holds dicts of the values
+# templates use instead of model instances; page[0].title and the like work
+# the same on both.
+PAGE_FIELDS = ('id', 'title', 'slug', 'pubdate', 'lastmoddate')
+POST_FIELDS = PAGE_FIELDS + ('year', 'month', 'day')
+STATUS_FIELDS = ('id', 'value')
+USER_FIELDS = ('id', 'username')
+TAG_FIELDS = ('id', 'value', 'count')
+
+def values(obj, fields):
+    """Return dict of the given attributes of obj"""
+    return dict((field, getattr(obj, field)) for field in fields)
+
+def row_values(rows, fields):
+    """Return list of (Post or Page, Status, User) tuples of dicts"""
+    return [(values(obj, fields), values(status, STATUS_FIELDS),
+             values(user, USER_FIELDS)) for obj, status, user in rows]
+
+@query_cache.cached('pages')
+def get_pages():
+    """Return list of published pages"""
+    return row_values(pages_base(), PAGE_FIELDS)
+
+@query_cache.cached('recent_posts')
+def get_recent_posts():
+    """Return list of most recent posts"""
+    posts = posts_base().order_by(PublishedPost.pubdate.desc())[0:10]
+    return row_values(posts, POST_FIELDS)
+
+@query_cache.cached('tags')
+def get_tag_cloud():
+    """Return list of [tag, fontsize] pairs sorted by tag value"""
     tags = db_session.query(Tag) \
             .filter(Tag.count>=1) \
             .order_by(Tag.count.desc()) \
             [0:app.config['TAGCLOUD_NR_OF_TAGS']]
+    if not tags:
+        return []
     # configured minimum and maximum font sizes to use
     min_size = app.config['TAGCLOUD_MIN_FONTSIZE']
     max_size = app.config['TAGCLOUD_MAX_FONTSIZE']
@@ -100,25 +223,45 @@ def inject_tag_cloud():
     # minimum and maximum counts of tag uses
     min_count = tags[-1].count
     max_count = tags[0].count
-    count_diff = max_count - min_count
+    count_diff = max(max_count - min_count, 1)
     tags_sizes = []
     for tag in tags:
         # consider min_count the zero baseline, what'd tag.count be?
         tag_relcount = tag.count - min_count
         size = min_size + ((tag_relcount * size_diff) / count_diff)
-        tags_sizes.append([tag, size])
-    return dict(tags=sorted(tags_sizes, key=lambda tag:tag[0].value))
+        tags_sizes.append([values(tag, TAG_FIELDS), size])
+    return sorted(tags_sizes, key=lambda tag:tag[0]['value'])
+
+@query_cache.cached('min_max_pubdates')
+def get_min_max_pubdates():
+    """Return list containing the first and last publication date"""
+    return db_session.query(
+            func.min(PublishedPost.pubdate),
+            func.max(PublishedPost.pubdate)) \
+            .filter(PublishedPost.pubdate <= datetime.now()).all()
+
+@app.context_processor
+def inject_pages():
+    """Add published pages to template context"""
+    return dict(pages=get_pages())
+
+@app.context_processor
+def inject_recent_posts():
+    """Add most recent post list to template context"""
+    return dict(recent_posts=get_recent_posts())
+
+@app.context_processor
+def inject_tag_cloud():
+    """Add tagcloud to template context."""
+    return dict(tags=get_tag_cloud())
 
 @app.context_processor
 def inject_archives():
     """TODO: inject archive list into template context"""
-    min_max_pubdates = db_session.query(
-            func.min(Post.pubdate),
-            func.max(Post.pubdate)).filter(filter_public())
     #min_year = min_max_pubdates[0].year()
     #max_year = min_max_pubdates[1].year()
     #archives = []
-    return dict(min_max_pubdates=min_max_pubdates)
+    return dict(min_max_pubdates=get_min_max_pubdates())
 # }}}
 
 # Template filters {{{
@@ -135,7 +278,7 @@ def tf_summarize(content, length=250, suffix='...'):
 @app.template_filter('to_html')
 def tf_to_html(content, format):
     """Convert input to html"""
-    return markup_to_html(format, content)
+    return render_markup(db_session, format, content, store=False)
 # }}}
 
 # Views {{{
@@ -155,34 +298,33 @@ def uploaded(filename):
     return viewer.uploaded(filename)
 
 @viewer.view('index')
+@page_cache.cached_view(last_modification)
 def show_index():
     """Render the front page"""
-    order = Post.pubdate.desc()
-    posts = get_posts(None, order)
-
     # add paginator just in case someone would like a post list as homepage
-    paginator = Paginator(posts, app.config['ENTRIES_PER_PAGE'],
-                          1, 'show_postlist')
-    return viewer.render('index.html', posts=posts, paginator=paginator)
+    paginator = get_paginator(None, 1, 'show_postlist')
+    return viewer.render('index.html', posts=paginator.entries,
+                         paginator=paginator)
 
 @viewer.view('show_post')
+@page_cache.cached_view(last_modification)
 def show_post(slug, **kwargs):
     """Render a Post"""
-    p_filter = Post.slug == slug
-    query = get_posts(p_filter)
+    p_filter = PublishedPost.slug == slug
+    post = get_posts(p_filter, columns=[Post.content_html]).first()
 
     # No result means the page doesn't exist
-    if query.count() < 1:
+    if post is None:
         abort(404)
 
-    post = query.first()
     return viewer.render('post.html', post=post[0])
 
 @viewer.view('show_page')
+@page_cache.cached_view(last_modification)
 def show_page(slug, **kwargs):
     """Render a Page"""
     p_filter = Page.slug == slug
-    query = pages_base().filter(p_filter)
+    query = pages_base().filter(p_filter).options(undefer(Page.content_html))
     # No result means the page doesn't exist
     if query.count() < 1:
         abort(404)
@@ -190,18 +332,17 @@ def show_page(slug, **kwargs):
     return viewer.render('page.html', page=page[0])
 
 @viewer.view('show_postlist')
+@page_cache.cached_view(last_modification)
 def show_postlist(page=1):
     """Render a paginated post list"""
     title = "Postlist"
-    p_order = Post.pubdate.desc()
-    posts = get_posts(None, p_order)
-    paginator = Paginator(posts, app.config['ENTRIES_PER_PAGE'], page,
-                          'show_postlist')
-    return viewer.render('post_list.html', posts=posts, paginator=paginator,
-                        title=title)
+    paginator = get_paginator(None, page, 'show_postlist')
+    return viewer.render('post_list.html', posts=paginator.entries,
+                         paginator=paginator, title=title)
 
 @viewer.view('show_postlist_by_month_index')
 @viewer.view('show_postlist_by_month')
+@page_cache.cached_view(last_modification)
 def show_postlist_by_month(year, month, page=1):
     """Render a post list filtered by month"""
     year = int(year)
@@ -215,23 +356,20 @@ def show_postlist_by_month(year, month, page=1):
     if month < 1 or month > 12:
         abort(404)
 
-    start_of_month = date(year, month, 1)
-    next_month = date(year + abs(month/12), (month % 12)+1, 1)
-    p_filter = and_(Post.pubdate > start_of_month, Post.pubdate < next_month)
-    p_order = Post.pubdate.desc()
-    posts = get_posts(p_filter, p_order)
+    p_filter = and_(PublishedPost.year == year, PublishedPost.month == month)
 
     month_name = date(1900,month,1).strftime('%B')
 
     title = "Posted in %s, %d" % (month_name, year)
-    paginator = Paginator(posts, app.config['ENTRIES_PER_PAGE'], page,
-                          'show_postlist_by_month', year=year, month=month)
+    paginator = get_paginator(p_filter, page, 'show_postlist_by_month',
+                              year=year, month='%02d' % month)
 
-    return viewer.render('post_list.html', posts=posts, paginator=paginator,
-                         title=title)
+    return viewer.render('post_list.html', posts=paginator.entries,
+                         paginator=paginator, title=title)
 
 @viewer.view('show_postlist_by_year_index')
 @viewer.view('show_postlist_by_year')
+@page_cache.cached_view(last_modification)
 def show_postlist_by_year(year, page=1):
     """Render a post list filtered by year"""
     year = int(year)
@@ -240,20 +378,18 @@ def show_postlist_by_year(year, page=1):
     if year < 1970 or year > 3000:
         abort(404)
 
-    p_filter = and_(Post.pubdate > date(year, 1, 1),
-                    Post.pubdate <= date(year+1, 1, 1))
-    p_order = Post.pubdate.desc()
+    p_filter = PublishedPost.year == year
 
     title = "Posted in %d" % year
-    posts = get_posts(p_filter, p_order)
-    paginator = Paginator(posts, app.config['ENTRIES_PER_PAGE'], page,
-                          'show_postlist_by_year', year=year)
+    paginator = get_paginator(p_filter, page, 'show_postlist_by_year',
+                              year=year)
 
-    return viewer.render('post_list.html', posts=posts, paginator=paginator,
-                         title=title)
+    return viewer.render('post_list.html', posts=paginator.entries,
+                         paginator=paginator, title=title)
 
 @viewer.view('show_postlist_by_tag_index')
 @viewer.view('show_postlist_by_tag')
+@page_cache.cached_view(last_modification)
 def show_postlist_by_tag(tag, page=1):
     """Render a post list filtered by tag"""
     tagobj = Tag.query.filter(Tag.value==tag).first()
@@ -261,18 +397,17 @@ def show_postlist_by_tag(tag, page=1):
     if tagobj is None:
         abort(404)
 
-    p_filter = Post.tags.contains(tagobj)
-    p_order = Post.pubdate.desc()
-    posts = get_posts(p_filter, p_order)
+    p_filter = and_(published_post_tags.c.post_id == PublishedPost.post_id,
+                    published_post_tags.c.tag_id == tagobj.id)
 
     title = "Posts tagged \"%s\"" % tag
-    paginator = Paginator(posts, app.config['ENTRIES_PER_PAGE'], page,
-                          'show_postlist_by_tag', tag=tag)
+    paginator = get_paginator(p_filter, page, 'show_postlist_by_tag', tag=tag)
 
-    return viewer.render('post_list.html', posts=posts, paginator=paginator,
-                         title=title)
+    return viewer.render('post_list.html', posts=paginator.entries,
+                         paginator=paginator, title=title)
 
 @viewer.view('show_postlist_by_username')
+@page_cache.cached_view(last_modification)
 def show_postlist_by_username(username, page=1):
     """Render a post list filtered by username"""
     userobj = User.query.filter(User.username==username).first()
@@ -280,30 +415,33 @@ def show_postlist_by_username(username, page=1):
     if userobj is None:
         abort(404)
 
-    p_filter = Post.user == userobj
-    p_order = Post.pubdate.desc()
-    posts = get_posts(p_filter, p_order)
+    p_filter = PublishedPost.user_id == userobj.id
 
     title = "Posts by %s" % username
-    paginator = Paginator(posts, app.config['ENTRIES_PER_PAGE'], page,
-                          'show_postlist_by_username', username=username)
+    paginator = get_paginator(p_filter, page, 'show_postlist_by_username',
+                              username=username)
 
-    return viewer.render('post_list.html', posts=posts, paginator=paginator,
-                         title=title)
+    return viewer.render('post_list.html', posts=paginator.entries,
+                         paginator=paginator, title=title)
 
 @viewer.view('show_atom')
+@page_cache.cached_view(last_modification)
 def show_atom():
     """Render atom feed with recent posts"""
-    p_order = Post.pubdate.desc()
-    posts = get_posts(None, p_order)[:app.config['FEEDITEMS']]
+    p_order = PublishedPost.pubdate.desc()
+    posts = get_posts(None, p_order, list_columns())[:app.config['FEEDITEMS']]
 
     return viewer.render('atom.xml', posts=posts)
 
 @viewer.view('show_rss')
+@page_cache.cached_view(last_modification)
 def show_rss():
     """Render RSS feed with recent posts"""
-    p_order = Post.pubdate.desc()
-    posts = get_posts(None, p_order)[:app.config['FEEDITEMS']]
+    p_order = PublishedPost.pubdate.desc()
+    # the feed converts the markup itself, which needs the format
+    posts = get_posts(None, p_order, [Post.content]) \
+            .options(*eager_options(app.config['EAGER_LOADING'], Post.format))
+    posts = posts[:app.config['FEEDITEMS']]
 
     return viewer.render('rss.xml', posts=posts)
 # }}}
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Description {{{
+"""
+    imposter.jobs
+    ~~~~~~~~~~~~~
+
+    Background compilation of posts and pages for the Imposter weblog app
+
+    Instead of converting markup to html while saving, the admin can add a
+    CompileJob to the database in the same transaction as the change. Jobs
+    are run by worker threads in the admin process, or by running this
+    module as a separate process:
+
+    usage: jobs.py
+
+    A worker compiles the post or page, claims the job by deleting it,
+    adjusts the tag counts and commits. If anything fails the deletion is
+    rolled back and the job is tried again later.
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+from datetime import datetime
+from threading import Thread, Event
+from sqlalchemy.sql import select
+from models import Post, Page, CompileJob, update_tag_counts
+from cache import invalidate
+
+import logging
+# }}}
+
+log = logging.getLogger('imposter.jobs')
+
+# Helper functions {{{
+def join_ids(ids):
+    """Return comma separated string of ids"""
+    return ','.join(str(id) for id in ids)
+
+def split_ids(value):
+    """Return list of ids from a comma separated string"""
+    if not value:
+        return []
+    return [int(id) for id in value.split(',')]
+
+def queue_post(db_session, post, old_tag_ids, new_tag_ids):
+    """Add job compiling post, call this in the transaction saving the post
+
+    :param old_tag_ids: post_tag_ids of the post before the change
+    :param new_tag_ids: post_tag_ids of the post after the change
+    """
+    db_session.add(CompileJob(post_id=post.id,
+                              old_tag_ids=join_ids(old_tag_ids),
+                              new_tag_ids=join_ids(new_tag_ids),
+                              createdate=datetime.now()))
+
+def queue_page(db_session, page):
+    """Add job compiling page, call this in the transaction saving the page"""
+    db_session.add(CompileJob(page_id=page.id, createdate=datetime.now()))
+
+def pending_ids(db_session, column, ids):
+    """Return set of the given ids which are still waiting to be compiled
+
+    :param column: CompileJob.post_id or CompileJob.page_id
+    """
+    if not ids:
+        return set()
+    return set(row[0] for row in
+               db_session.query(column).filter(column.in_(ids)).distinct())
+
+def run_job(db_session, job, repl=None):
+    """Compile the post or page of a job and commit
+
+    Returns False if the job was already claimed by another worker.
+    """
+    # compile before claiming the job, rendering may write to the database
+    # on a connection of its own
+    if job.post_id is not None:
+        post = db_session.query(Post).get(job.post_id)
+        if post is not None:
+            post.compile(db_session, repl)
+    if job.page_id is not None:
+        page = db_session.query(Page).get(job.page_id)
+        if page is not None:
+            page.compile(db_session, repl)
+
+    jobs = CompileJob.__table__
+    if db_session.execute(jobs.delete().where(jobs.c.id==job.id)) \
+            .rowcount == 0:
+        db_session.rollback()
+        return False
+    if job.post_id is not None:
+        update_tag_counts(db_session, set(split_ids(job.old_tag_ids)) |
+                          set(split_ids(job.new_tag_ids)))
+    db_session.commit()
+    return True
+
+def run_pending(db_session, repl=None, stamp_file=None):
+    """Run all jobs waiting in the database, oldest first
+
+    The caches using stamp_file are invalidated if any job was run. Returns
+    the number of jobs run.
+    """
+    jobs = CompileJob.__table__
+    done = 0
+    for job in db_session.execute(select([jobs]).order_by(jobs.c.id)) \
+            .fetchall():
+        try:
+            if run_job(db_session, job, repl):
+                done += 1
+        except Exception:
+            db_session.rollback()
+            log.exception('Compile job %d failed' % job.id)
+    if done:
+        invalidate(stamp_file)
+    return done
+# }}}
+
+# Classes {{{
+class Worker(Thread):
+    """Thread running the pending jobs every interval seconds, or as soon
+    as notify is called
+
+    :param db_session: scoped session using the primary database, every
+                       thread uses its own session
+    :param repl: dict of strings to replace before converting to html
+    :param stamp_file: stamp file to touch after running jobs
+    :param interval: number of seconds between checks for new jobs
+    """
+    def __init__(self, db_session, repl=None, stamp_file=None, interval=10):
+        Thread.__init__(self)
+        self.daemon = True
+        self.db_session = db_session
+        self.repl = repl
+        self.stamp_file = stamp_file
+        self.interval = interval
+        self.event = Event()
+
+    def notify(self):
+        """Wake the worker up"""
+        self.event.set()
+
+    def run(self):
+        while True:
+            try:
+                run_pending(self.db_session, self.repl, self.stamp_file)
+            except Exception:
+                log.exception('Running compile jobs failed')
+            finally:
+                self.db_session.remove()
+            self.event.wait(self.interval)
+            self.event.clear()
+
+class Workers(object):
+    """Group of started Worker threads"""
+    def __init__(self, number, *args, **kwargs):
+        self.workers = [Worker(*args, **kwargs) for i in range(number)]
+        for worker in self.workers:
+            worker.start()
+
+    def notify(self):
+        """Wake all workers up"""
+        for worker in self.workers:
+            worker.notify()
+# }}}
+
+#---------------------------------------------------------------------------
+# MAIN RUN LOOP
+if __name__ == '__main__':
+    from flask import Flask
+    from database import DB, db_options
+
+    logging.basicConfig()
+    app = Flask(__name__)
+    app.config.from_pyfile('config_admin.py')
+    app.config.from_envvar('IMPOSTER_ADMIN_CONFIG', silent=True)
+    Worker(DB(app.config['DATABASE'],
+              **db_options(app.config)).get_session(primary=True),
+           app.config['REPL_TAGS'],
+           app.config['CACHE_STAMP_FILE'],
+           app.config['COMPILE_POLL_INTERVAL']).run()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Description {{{
+"""
+    imposter.lookups
+    ~~~~~~~~~~~~~~~~
+
+    Process wide cache of the Status and Format reference tables
+
+    These tables are filled by dbmanage.py and don't change afterwards, so
+    they are read once per process and values are resolved to ids and objects
+    without touching the database. Unknown values make the tables reload at
+    most once every RELOAD_INTERVAL seconds, so invalid input can't make
+    every request scan them.
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+from time import time
+from models import Status, Format
+# }}}
+
+# minimum number of seconds between reloads caused by unknown values
+RELOAD_INTERVAL = 60
+
+# Classes {{{
+class Lookups(object):
+    """Cache of the Status and Format objects, by model and value"""
+    models = (Status, Format)
+
+    def __init__(self):
+        self.objects = None
+        self.loaded = None
+
+    def reload(self, db_session):
+        """(Re)load the reference tables from the database"""
+        objects = {}
+        for model in self.models:
+            for obj in db_session.query(model).order_by(model.id):
+                db_session.expunge(obj)
+                objects[(model, obj.value)] = obj
+        self.objects = objects
+        self.loaded = time()
+
+    def get_object(self, db_session, model, value):
+        """Return cached object, loading the tables if needed
+
+        Raises KeyError if the value doesn't exist.
+        """
+        if self.objects is None or ((model, value) not in self.objects and
+                                    time() - self.loaded >= RELOAD_INTERVAL):
+            self.reload(db_session)
+        return self.objects[(model, value)]
+
+    def get_id(self, db_session, model, value):
+        """Return id of the object of given model with given value"""
+        return self.get_object(db_session, model, value).id
+
+    def get(self, db_session, model, value):
+        """Return object of given model with given value, attached to
+        db_session without querying the database"""
+        obj = self.get_object(db_session, model, value)
+        return db_session.merge(obj, load=False)
+
+    def all(self, db_session, model):
+        """Return all objects of given model, attached to db_session"""
+        if self.objects is None:
+            self.reload(db_session)
+        objects = [obj for (obj_model, value), obj in self.objects.items()
+                   if obj_model is model]
+        objects.sort(key=lambda obj: obj.id)
+        return [db_session.merge(obj, load=False) for obj in objects]
+# }}}
+
+lookups = Lookups()
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# Description {{{
+"""
+    imposter.metrics
+    ~~~~~~~~~~~~~~~~
+
+    Operational metrics for the Imposter weblog apps
+
+    Metrics are kept per process in the registry of this module and served in
+    the Prometheus text exposition format on METRICS_PATH. Request latencies
+    and markup compile times are recorded as they happen, which costs a
+    dictionary lookup and a few additions. Cache hit counts and connection
+    pool usage are only read when the metrics are requested.
+
+    When an app runs in several processes, as with FastCGI, every process
+    reports its own metrics. Let Prometheus add them up.
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+from __future__ import with_statement
+from flask import g, request
+from bisect import bisect_left
+from threading import Lock
+from time import time
+from sqlalchemy.engine.url import make_url
+from database import pool_statistics
+# }}}
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Helper functions {{{
+def format_labels(names, values):
+    """Return {name="value",...} string for the given label names and values"""
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, unicode(value)
+                             .replace('\\', '\\\\').replace('"', '\\"')
+                             .replace('\n', '\\n'))
+                             for name, value in zip(names, values))
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+def safe_url(dbstring):
+    """Return dbstring without the password"""
+    return repr(make_url(dbstring))
+# }}}
+
+# Classes {{{
+class Counter(object):
+    """Value which only goes up, per combination of label values"""
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, *label_values, **kwargs):
+        """Add amount (default 1) for the given label values"""
+        amount = kwargs.get('amount', 1)
+        with self.lock:
+            self.values[label_values] = \
+                    self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        """Return list of (name, labels, value) tuples"""
+        with self.lock:
+            return [(self.name, format_labels(self.labels, label_values),
+                     value)
+                    for label_values, value in sorted(self.values.items())]
+
+class Histogram(object):
+    """Distribution of observed values, per combination of label values
+
+    :param buckets: sorted upper bounds of the buckets
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                # counts per bucket, sum of the values
+                entry = self.values[label_values] = \
+                        [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        out = []
+        with self.lock:
+            values = sorted((label_values, (list(counts), total))
+                            for label_values, (counts, total)
+                            in self.values.items())
+        names = tuple(self.labels) + ('le',)
+        for label_values, (counts, total) in values:
+            count = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),),
+                                           counts):
+                count += bucket_count
+                out.append(('%s_bucket' % self.name,
+                            format_labels(names, label_values +
+                                          (format_value(bound),)),
+                            count))
+            labels = format_labels(self.labels, label_values)
+            out.append(('%s_sum' % self.name, labels, total))
+            out.append(('%s_count' % self.name, labels, count))
+        return out
+
+class Collected(object):
+    """Metric whose samples are read by a function when the metrics are
+    requested
+
+    :param type: 'gauge' or 'counter'
+    :param collect: function returning list of (label values, value) tuples
+    """
+    def __init__(self, name, documentation, type, labels, collect):
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, format_labels(self.labels, label_values), value)
+                for label_values, value in self.collect()]
+
+class Registry(object):
+    """All metrics of the process"""
+    def __init__(self):
+        self.metrics = []
+        self.caches = {}
+
+    def add(self, metric):
+        """Register metric and return it"""
+        self.metrics.append(metric)
+        return metric
+
+    def add_cache(self, name, cache):
+        """Report the hits and misses of a TimedCache under name"""
+        self.caches[name] = cache
+
+    def cache_samples(self, attribute):
+        return [((name,), getattr(cache, attribute))
+                for name, cache in sorted(self.caches.items())]
+
+    def cache_hit_ratios(self):
+        out = []
+        for name, cache in sorted(self.caches.items()):
+            lookups = cache.hits + cache.misses
+            if lookups:
+                out.append(((name,), float(cache.hits) / lookups))
+        return out
+
+    def render(self):
+        """Return all metrics in the text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            samples = metric.samples()
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend('%s%s %s' % (name, labels, format_value(value))
+                         for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+class Metrics(object):
+    """Record the request latencies of app and serve the metrics
+
+    Config keys are read with the given prefix, for example
+    PUBLIC_API_METRICS_PATH for the prefix 'PUBLIC_API_'. Nothing is done
+    if the path is None.
+
+    :param app: Flask application
+    :param name: name of the app, used as label
+    :param url_prefix: prefix of the routes of the app, like 'imposter/'
+    :param prefix: prefix of the config keys
+    """
+    def __init__(self, app, name, url_prefix='', prefix=''):
+        self.app = app
+        self.name = name
+        path = app.config.get(prefix + 'METRICS_PATH')
+        if path is None:
+            return
+
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+        app.add_url_rule('/%s%s' % (url_prefix, path), 'metrics',
+                         self.show_metrics)
+
+    def start_request(self):
+        g.metrics_start = time()
+
+    def end_request(self, response):
+        start = getattr(g, 'metrics_start', None)
+        if start is not None:
+            request_seconds.observe(time() - start, self.name,
+                                    request.endpoint or 'none')
+        return response
+
+    def show_metrics(self):
+        """Send the metrics of this process"""
+        return self.app.response_class(registry.render(),
+                                       content_type=CONTENT_TYPE)
+# }}}
+
+registry = Registry()
+
+request_seconds = registry.add(Histogram(
+    'imposter_request_seconds', 'Time spent handling requests',
+    ('app', 'route')))
+
+markup_compile_seconds = registry.add(Histogram(
+    'imposter_markup_compile_seconds', 'Time spent converting markup to html',
+    ('format',)))
+
+markup_lookups = registry.add(Counter(
+    'imposter_markup_lookups_total',
+    'Rendered markup found in memory, in the database or rendered',
+    ('result',)))
+
+registry.add(Collected(
+    'imposter_cache_hits_total', 'Cache lookups finding an entry', 'counter',
+    ('cache',), lambda: registry.cache_samples('hits')))
+
+registry.add(Collected(
+    'imposter_cache_misses_total', 'Cache lookups finding nothing', 'counter',
+    ('cache',), lambda: registry.cache_samples('misses')))
+
+registry.add(Collected(
+    'imposter_cache_hit_ratio', 'Fraction of the cache lookups finding an '
+    'entry', 'gauge', ('cache',), registry.cache_hit_ratios))
+
+def pool_collector(key):
+    """Return function collecting a value of the pool statistics"""
+    def collect():
+        return [((safe_url(dbstring),), statistics[key])
+                for dbstring, statistics in sorted(pool_statistics().items())
+                if key in statistics]
+    return collect
+
+for key, kind, documentation in [
+        ('checked_out', 'gauge', 'Database connections in use'),
+        ('size', 'gauge', 'Database connections kept open by the pool'),
+        ('overflow', 'gauge', 'Database connections opened beyond the pool '
+         'size'),
+        ('connects', 'counter', 'Database connections opened'),
+        ('checkouts', 'counter', 'Database connections taken from the pool'),
+        ('wait_time', 'counter', 'Seconds spent waiting for a database '
+         'connection')]:
+    name = 'imposter_db_pool_%s' % key
+    if kind == 'counter':
+        name = name.replace('wait_time', 'wait_seconds') + '_total'
+    registry.add(Collected(name, documentation, kind, ('database',),
+                           pool_collector(key)))
@@ -0,0 +1,46 @@
+from sqlalchemy import *
+from sqlalchemy.ext.declarative import declarative_base
+from migrate import *
+from models import tn
+
+Base = declarative_base()
+meta = Base.metadata
+
+def get_tables():
+    posts = Table(tn('posts'), meta, autoload=True)
+    users = Table(tn('users'), meta, autoload=True)
+    tags = Table(tn('tags'), meta, autoload=True)
+
+    published_posts = Table(tn('published_posts'), meta,
+        Column('post_id', Integer, ForeignKey(posts.c.id), primary_key=True),
+        Column('slug', String(128), nullable=False),
+        Column('pubdate', DateTime, nullable=False),
+        Column('year', Integer, nullable=False),
+        Column('month', Integer, nullable=False),
+        Column('user_id', Integer, ForeignKey(users.c.id), nullable=False),
+        Index(tn('published_posts_pubdate'), 'pubdate', 'post_id'),
+        Index(tn('published_posts_slug'), 'slug'),
+        Index(tn('published_posts_year_month'), 'year', 'month', 'pubdate'),
+        Index(tn('published_posts_user'), 'user_id', 'pubdate'),
+        )
+
+    published_post_tags = Table(tn('published_post_tags'), meta,
+        Column('post_id', Integer, ForeignKey(posts.c.id), primary_key=True),
+        Column('tag_id', Integer, ForeignKey(tags.c.id), primary_key=True),
+        Column('pubdate', DateTime, nullable=False),
+        Index(tn('published_post_tags_tag'), 'tag_id', 'pubdate', 'post_id'),
+        )
+
+    return published_posts, published_post_tags
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    published_posts, published_post_tags = get_tables()
+    published_posts.create()
+    published_post_tags.create()
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    published_posts, published_post_tags = get_tables()
+    published_post_tags.drop()
+    published_posts.drop()
@@ -0,0 +1,38 @@
+from sqlalchemy import *
+from sqlalchemy.ext.declarative import declarative_base
+from migrate import *
+from models import tn
+
+Base = declarative_base()
+meta = Base.metadata
+
+def get_indexes():
+    posts = Table(tn('posts'), meta, autoload=True)
+    post_tags = Table(tn('post_tags'), meta, autoload=True)
+    tags = Table(tn('tags'), meta, autoload=True)
+    pages = Table(tn('pages'), meta, autoload=True)
+
+    # pages.slug and tags.value are unique, so they are indexed already
+    return [
+        Index(tn('posts_slug'), posts.c.slug),
+        Index(tn('posts_status_pubdate'), posts.c.status_id, posts.c.pubdate),
+        Index(tn('posts_user_createdate'), posts.c.user_id,
+              posts.c.createdate, posts.c.id),
+        Index(tn('posts_lastmoddate'), posts.c.lastmoddate),
+        Index(tn('post_tags_post'), post_tags.c.post_id, post_tags.c.tag_id),
+        Index(tn('post_tags_tag'), post_tags.c.tag_id, post_tags.c.post_id),
+        Index(tn('tags_count'), tags.c.count),
+        Index(tn('pages_status_pubdate'), pages.c.status_id, pages.c.pubdate),
+        Index(tn('pages_user_createdate'), pages.c.user_id,
+              pages.c.createdate, pages.c.id),
+        ]
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for index in get_indexes():
+        index.create(migrate_engine)
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for index in get_indexes():
+        index.drop(migrate_engine)
@@ -0,0 +1,22 @@
+from sqlalchemy import *
+from sqlalchemy.ext.declarative import declarative_base
+from migrate import *
+from models import tn
+
+Base = declarative_base()
+meta = Base.metadata
+
+class RenderedMarkup(Base):
+    __tablename__ = tn('rendered_markup')
+
+    hash = Column(String(40), primary_key=True)
+    html = Column(Text, nullable=False)
+    createdate = Column(DateTime, nullable=False)
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    RenderedMarkup.__table__.create()
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    RenderedMarkup.__table__.drop()
@@ -0,0 +1,30 @@
+from sqlalchemy import *
+from sqlalchemy.ext.declarative import declarative_base
+from migrate import *
+from models import tn
+
+Base = declarative_base()
+meta = Base.metadata
+
+def get_table():
+    posts = Table(tn('posts'), meta, autoload=True)
+    pages = Table(tn('pages'), meta, autoload=True)
+
+    return Table(tn('compile_jobs'), meta,
+        Column('id', Integer, primary_key=True),
+        Column('post_id', Integer, ForeignKey(posts.c.id), nullable=True),
+        Column('page_id', Integer, ForeignKey(pages.c.id), nullable=True),
+        Column('old_tag_ids', Text, nullable=True),
+        Column('new_tag_ids', Text, nullable=True),
+        Column('createdate', DateTime, nullable=False),
+        Index(tn('compile_jobs_post'), 'post_id'),
+        Index(tn('compile_jobs_page'), 'page_id'),
+        )
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    get_table().create()
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    get_table().drop()
@@ -0,0 +1,34 @@
+from sqlalchemy import *
+from sqlalchemy.ext.declarative import declarative_base
+from migrate import *
+from models import tn
+
+Base = declarative_base()
+meta = Base.metadata
+
+class Tombstone(Base):
+    __tablename__ = tn('tombstones')
+
+    id = Column(Integer, primary_key=True)
+    type = Column(String(8), nullable=False)
+    object_id = Column(Integer, nullable=False)
+    slug = Column(String(128), nullable=False)
+    createdate = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index(tn('tombstones_createdate'), 'createdate', 'id'),
+        )
+
+def get_index():
+    pages = Table(tn('pages'), meta, autoload=True)
+    return Index(tn('pages_lastmoddate'), pages.c.lastmoddate)
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    Tombstone.__table__.create()
+    get_index().create(migrate_engine)
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    get_index().drop(migrate_engine)
+    Tombstone.__table__.drop()
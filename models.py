@@ -1,9 +1,15 @@
-from sqlalchemy import Table, Column, Integer, String, Text, DateTime, ForeignKey
-from sqlalchemy.orm import mapper, relation, relationship, backref
-from database import Base, ImposterBase
-from time import strftime
-from config import TABLEPREFIX
+from sqlalchemy import Table, Column, Index, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy.orm import mapper, relation, relationship, backref, deferred
+from sqlalchemy.sql import select, and_, func
+from sqlalchemy.exc import IntegrityError
+from database import Base, ImposterBase, Serializer
+from cache import MemoryBackend
+from datetime import datetime
+from hashlib import sha1
+from time import strftime, time
+from config import TABLEPREFIX, MARKUP_CACHE_SIZE
 from flaskjk import markup_to_html, multi_replace
+from metrics import markup_compile_seconds, markup_lookups
 
 def tn(tablename):
     """ shortcut to get tablename with prefix """
@@ -11,7 +17,9 @@ def tn(tablename):
 
 post_tags = Table(tn('post_tags'), Base.metadata,
              Column('post_id', Integer, ForeignKey('%s.id' % tn('posts'))),
-             Column('tag_id', Integer, ForeignKey('%s.id' % tn('tags')))
+             Column('tag_id', Integer, ForeignKey('%s.id' % tn('tags'))),
+             Index(tn('post_tags_post'), 'post_id', 'tag_id'),
+             Index(tn('post_tags_tag'), 'tag_id', 'post_id')
              )
 
 class Status(Base,ImposterBase):
@@ -47,6 +55,81 @@ class Format(Base,ImposterBase):
     def __repr__(self):
         return '<Format %r>' % self.value
 
+class RenderedMarkup(Base):
+    """HTML rendered from markup, stored by hash of its input"""
+    __tablename__ = tn('rendered_markup')
+
+    hash = Column(String(40), primary_key=True)
+    html = Column(Text, nullable=False)
+    createdate = Column(DateTime, nullable=False)
+
+    def __init__(self, hash, html):
+        self.hash = hash
+        self.html = html
+        self.createdate = datetime.now()
+
+    def __repr__(self):
+        return '<RenderedMarkup %s>' % self.hash
+
+# most recently used rendered markup, by hash
+markup_cache = MemoryBackend(MARKUP_CACHE_SIZE)
+
+def markup_hash(format, content, repl=None):
+    """Return hash identifying the html rendered from the given input"""
+    data = [unicode(format), content]
+    if repl is not None:
+        data.append(sorted(repl.items()))
+    return sha1(repr(data)).hexdigest()
+
+def render_markup(db_session, format, content, repl=None, store=True):
+    """Convert markup to html, rendering identical input only once
+
+    Rendered html is looked up in memory, then in the rendered_markup table.
+    Only if both miss the markup is rendered.
+
+    :param db_session: session used to look up and store rendered html
+    :param format: Format object or format name
+    :param content: markup to convert
+    :param repl: dict of strings to replace before converting
+    :param store: store newly rendered html in the database, set to False
+                  for applications without write access
+    """
+    if content is None:
+        return markup_to_html(format, content)
+
+    key = markup_hash(format, content, repl)
+    html = markup_cache.get(key)
+    if html is not None:
+        markup_lookups.inc('memory')
+        return html
+
+    rendered = db_session.query(RenderedMarkup).get(key)
+    if rendered is not None:
+        markup_lookups.inc('database')
+        markup_cache.set(key, rendered.html)
+        return rendered.html
+
+    if repl is not None:
+        content = multi_replace(content, repl)
+    start = time()
+    html = markup_to_html(format, content)
+    markup_compile_seconds.observe(time() - start, unicode(format))
+    markup_lookups.inc('rendered')
+    markup_cache.set(key, html)
+
+    if store:
+        # commit separately, another request may store the same html
+        insert = RenderedMarkup.__table__.insert()
+        conn = db_session.get_bind(clause=insert).connect()
+        try:
+            conn.execute(insert,
+                         dict(hash=key, html=html, createdate=datetime.now()))
+        except IntegrityError:
+            pass
+        finally:
+            conn.close()
+    return html
+
 class Tag(Base,ImposterBase):
     __tablename__ = tn('tags')
 
@@ -56,6 +139,10 @@ class Tag(Base,ImposterBase):
 
     __public_columns__ = [ value, count ]
 
+    __table_args__ = (
+        Index(tn('tags_count'), 'count'),
+        )
+
     def __init__(self, value):
         self.value = value
 
@@ -90,8 +177,10 @@ class Post(Base,ImposterBase):
     id = Column(Integer, primary_key=True)
     title = Column(String(200), nullable=False)
     slug = Column(String(128), nullable=False)
-    summary = Column(Text, nullable=True)
-    content = Column(Text, nullable=False)
+    # the large text columns are only loaded when used, or when the query
+    # asks for them with sqlalchemy.orm.undefer_group('markup') / ('html')
+    summary = deferred(Column(Text, nullable=True), group='markup')
+    content = deferred(Column(Text, nullable=False), group='markup')
     status_id = Column(Integer, ForeignKey(Status.id), nullable=False)
     user_id = Column(Integer, ForeignKey(User.id), nullable=False)
     format_id = Column(Integer, ForeignKey(Format.id), nullable=False)
@@ -105,11 +194,18 @@ class Post(Base,ImposterBase):
     tags = relationship('Tag', secondary=post_tags, backref='posts')
     format = relationship(Format, backref='posts')
 
-    summary_html = Column(Text, nullable=True)
-    content_html = Column(Text, nullable=True)
+    summary_html = deferred(Column(Text, nullable=True), group='html')
+    content_html = deferred(Column(Text, nullable=True), group='html')
 
     __public_columns__ = [ title, slug, summary_html, content_html, pubdate, lastmoddate, tags ]
 
+    __table_args__ = (
+        Index(tn('posts_slug'), 'slug'),
+        Index(tn('posts_status_pubdate'), 'status_id', 'pubdate'),
+        Index(tn('posts_user_createdate'), 'user_id', 'createdate', 'id'),
+        Index(tn('posts_lastmoddate'), 'lastmoddate'),
+        )
+
     def __init__(self, title=None, summary=None, content=None, createdate=None, pubdate=None, lastmoddate=None):
         self.title = title
         self.summary = summary
@@ -118,15 +214,11 @@ class Post(Base,ImposterBase):
         self.pubdate = pubdate
         self.lastmoddate = lastmoddate
 
-    def compile(self, repl=None):
-        input_summary = self.summary
-        input_content = self.content
-        if repl is not None:
-            input_summary = multi_replace(input_summary, repl)
-            input_content = multi_replace(input_content, repl)
-
-        self.summary_html = markup_to_html(self.format, input_summary)
-        self.content_html = markup_to_html(self.format, input_content)
+    def compile(self, db_session, repl=None):
+        self.summary_html = render_markup(db_session, self.format,
+                                          self.summary, repl)
+        self.content_html = render_markup(db_session, self.format,
+                                          self.content, repl)
 
     def __repr__(self):
         return '<Post %s>' % self.title
@@ -143,17 +235,18 @@ class Post(Base,ImposterBase):
     def day(self):
         return '%02d' % self.pubdate.day
 
-class Page(Base):
+class Page(Base,ImposterBase):
     __tablename__ = tn('pages')
 
     id = Column(Integer, primary_key=True)
     title = Column(String(200), unique=True, nullable=False)
     slug = Column(String(128), unique=True, nullable=False)
-    content = Column(Text, nullable=False)
+    # see Post
+    content = deferred(Column(Text, nullable=False), group='markup')
     status_id = Column(Integer, ForeignKey(Status.id), nullable=False)
     user_id = Column(Integer, ForeignKey(User.id), nullable=False)
     format_id = Column(Integer, ForeignKey(Format.id), nullable=False)
-    content_html = Column(Text, nullable=True)
+    content_html = deferred(Column(Text, nullable=True), group='html')
 
     createdate = Column(DateTime, nullable=False)
     pubdate = Column(DateTime, nullable=True)
@@ -165,6 +258,12 @@ class Page(Base):
 
     __public_columns__ = [ title, slug, content_html, pubdate, lastmoddate ]
 
+    __table_args__ = (
+        Index(tn('pages_status_pubdate'), 'status_id', 'pubdate'),
+        Index(tn('pages_user_createdate'), 'user_id', 'createdate', 'id'),
+        Index(tn('pages_lastmoddate'), 'lastmoddate'),
+        )
+
     def __init__(self, title=None, content=None, createdate=None, pubdate=None, lastmoddate=None):
         self.title = title
         self.content = content
@@ -172,13 +271,177 @@ class Page(Base):
         self.pubdate = pubdate
         self.lastmoddate = lastmoddate
 
-    def compile(self, repl=None):
-        input_content = self.content
-        if repl is not None:
-            input_content = multi_replace(input_content, repl)
-
-        self.content_html = markup_to_html(self.format, input_content)
+    def compile(self, db_session, repl=None):
+        self.content_html = render_markup(db_session, self.format,
+                                          self.content, repl)
 
     def __repr__(self):
         return '<Page %s>' % self.title
 
+class PublishedPost(Base):
+    """Narrow copy of the data needed to find published posts
+
+    Maintained by refresh_published_post on every change to a Post, so
+    public queries can filter and sort on a single indexed table instead of
+    joining posts, status and users.
+    """
+    __tablename__ = tn('published_posts')
+
+    post_id = Column(Integer, ForeignKey(Post.id), primary_key=True)
+    slug = Column(String(128), nullable=False)
+    pubdate = Column(DateTime, nullable=False)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    user_id = Column(Integer, ForeignKey(User.id), nullable=False)
+
+    __table_args__ = (
+        Index(tn('published_posts_pubdate'), 'pubdate', 'post_id'),
+        Index(tn('published_posts_slug'), 'slug'),
+        Index(tn('published_posts_year_month'), 'year', 'month', 'pubdate'),
+        Index(tn('published_posts_user'), 'user_id', 'pubdate'),
+        )
+
+    def __repr__(self):
+        return '<PublishedPost %s>' % self.slug
+
+published_post_tags = Table(tn('published_post_tags'), Base.metadata,
+             Column('post_id', Integer, ForeignKey(Post.id), primary_key=True),
+             Column('tag_id', Integer, ForeignKey(Tag.id), primary_key=True),
+             Column('pubdate', DateTime, nullable=False),
+             Index(tn('published_post_tags_tag'), 'tag_id', 'pubdate', 'post_id')
+             )
+
+class CompileJob(Base):
+    """Post or Page waiting to be compiled by a background worker
+
+    For posts, old_tag_ids and new_tag_ids hold the comma separated
+    post_tag_ids from before and after the change, so the worker can
+    recount those tags afterwards.
+    """
+    __tablename__ = tn('compile_jobs')
+
+    id = Column(Integer, primary_key=True)
+    post_id = Column(Integer, ForeignKey(Post.id), nullable=True)
+    page_id = Column(Integer, ForeignKey(Page.id), nullable=True)
+    old_tag_ids = Column(Text, nullable=True)
+    new_tag_ids = Column(Text, nullable=True)
+    createdate = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index(tn('compile_jobs_post'), 'post_id'),
+        Index(tn('compile_jobs_page'), 'page_id'),
+        )
+
+    def __repr__(self):
+        return '<CompileJob %d>' % self.id
+
+class Tombstone(Base):
+    """Post or page which disappeared from its URL
+
+    Written when a post or page is unpublished or gets another slug, so
+    clients of the public API change feed know what to remove.
+    """
+    __tablename__ = tn('tombstones')
+
+    id = Column(Integer, primary_key=True)
+    type = Column(String(8), nullable=False)
+    object_id = Column(Integer, nullable=False)
+    slug = Column(String(128), nullable=False)
+    createdate = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index(tn('tombstones_createdate'), 'createdate', 'id'),
+        )
+
+    def __repr__(self):
+        return '<Tombstone %s %s>' % (self.type, self.slug)
+
+def add_tombstone(db_session, type, object_id, slug):
+    """Record that the post or page with the given slug disappeared
+
+    :param type: 'post' or 'page'
+    """
+    db_session.execute(Tombstone.__table__.insert(), dict(
+        type=type, object_id=object_id, slug=slug, createdate=datetime.now()))
+
+def refresh_published_post(db_session, post):
+    """Add, update or remove the PublishedPost of a Post
+
+    Call this in the same transaction as every change to a Post. Posts with
+    status 'public' and a publication date are published; publication dates
+    in the future are left to be filtered by the queries. A Tombstone is
+    added if a published post is unpublished or its slug changed.
+    """
+    published_posts = PublishedPost.__table__
+    old_slug = db_session.execute(select([published_posts.c.slug]).where(
+        published_posts.c.post_id==post.id)).scalar()
+    db_session.execute(published_post_tags.delete().where(
+        published_post_tags.c.post_id==post.id))
+    db_session.execute(published_posts.delete().where(
+        published_posts.c.post_id==post.id))
+
+    published = post.status is not None and post.status.value == 'public' \
+            and post.pubdate is not None
+    if old_slug is not None and (not published or old_slug != post.slug):
+        add_tombstone(db_session, 'post', post.id, old_slug)
+    if not published:
+        return
+
+    db_session.execute(published_posts.insert(), dict(
+        post_id=post.id,
+        slug=post.slug,
+        pubdate=post.pubdate,
+        year=post.pubdate.year,
+        month=post.pubdate.month,
+        user_id=post.user_id))
+    if post.tags:
+        db_session.execute(published_post_tags.insert(), [
+            dict(post_id=post.id, tag_id=tag.id, pubdate=post.pubdate)
+            for tag in post.tags])
+
+def rebuild_published_posts(db_session):
+    """Rebuild the PublishedPost data of all posts"""
+    db_session.execute(published_post_tags.delete())
+    db_session.execute(PublishedPost.__table__.delete())
+    for post in db_session.query(Post):
+        refresh_published_post(db_session, post)
+
+def tag_values(db_session, post_ids):
+    """Return dict of post id: list of tag values for the given posts"""
+    values = dict((post_id, []) for post_id in post_ids)
+    if not post_ids:
+        return values
+    for post_id, value in db_session.query(post_tags.c.post_id, Tag.value) \
+            .filter(and_(post_tags.c.tag_id==Tag.id,
+                         post_tags.c.post_id.in_(post_ids))) \
+            .order_by(Tag.value):
+        values[post_id].append(value)
+    return values
+
+def post_tag_ids(db_session, post_id):
+    """Return ids of the tags of a post, whether it is published or not"""
+    return [row[0] for row in db_session.execute(
+        select([post_tags.c.tag_id]).where(post_tags.c.post_id==post_id))]
+
+def update_tag_counts(db_session, tag_ids=None):
+    """Recount how many published posts use each tag
+
+    All counts are updated by a single UPDATE statement with a correlated
+    subquery on published_post_tags.
+
+    :param tag_ids: only recount these tags, all tags if None
+    """
+    tags = Tag.__table__
+    count = select([func.count(published_post_tags.c.post_id)]).where(and_(
+        published_post_tags.c.tag_id==tags.c.id,
+        published_post_tags.c.pubdate <= datetime.now())).as_scalar()
+    stmt = tags.update().values(count=count)
+    if tag_ids is not None:
+        if not tag_ids:
+            return
+        stmt = stmt.where(tags.c.id.in_(tag_ids))
+    db_session.execute(stmt)
+
+# serializers of the public data of the models, see ImposterBase
+for model in (Status, Format, Tag, User, Post, Page):
+    model.__serializer__ = Serializer(model)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Description {{{
+"""
+    imposter.pagination
+    ~~~~~~~~~~~~~~~~~~~
+
+    Keyset pagination for the Imposter weblog app
+
+    Instead of skipping (page - 1) * per_page rows with an OFFSET, the
+    KeysetPaginator seeks to the first row of a page using the sort key of
+    the last row of the previous page. The links to the next and previous
+    pages carry that key in their query string, so browsing through a list
+    only ever fetches the rows which are shown.
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+from flask import request, url_for, abort
+from datetime import datetime
+from sqlalchemy.sql import and_, or_
+# }}}
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+# Helper functions {{{
+def encode_cursor(key):
+    """Return string representation of a (datetime, id) sort key"""
+    return '%s-%d' % (key[0].strftime(CURSOR_DATE_FORMAT), key[1])
+
+def decode_cursor(cursor):
+    """Return (datetime, id) sort key, None if the cursor is invalid"""
+    try:
+        date, id = cursor.split('-')
+        return (datetime.strptime(date, CURSOR_DATE_FORMAT), int(id))
+    except (AttributeError, ValueError):
+        return None
+
+def rows_after(sort_column, id_column, key):
+    """Filter for rows coming after a (datetime, id) key in descending order"""
+    return or_(sort_column < key[0],
+               and_(sort_column == key[0], id_column < key[1]))
+# }}}
+
+# Classes {{{
+class KeysetPaginator(object):
+    """Paginate a query on a (datetime, id) sort key, newest first
+
+    A page requested without a cursor, such as the first or the last page,
+    is located by reading only the sort keys of the preceding rows. Pages
+    before the first and past the last one abort with 404 Not Found, so they
+    don't show (and get cached as) a copy of the first page.
+
+    :param query: query to paginate, without ordering
+    :param per_page: number of entries per page
+    :param page: page number
+    :param endpoint: endpoint used to build the links to other pages
+    :param sort_column: datetime column to sort by, must not be NULL
+    :param id_column: unique column to break ties with
+    :param count_query: query used to count the entries, defaults to query
+    :param count_cache: TimedCache to store the number of entries in
+    :param options: query options used when fetching the entries, such as
+                    eager loading options
+    :param kwargs: additional arguments for url_for
+    """
+    def __init__(self, query, per_page, page, endpoint, sort_column,
+                 id_column, count_query=None, count_cache=None, options=None,
+                 **kwargs):
+        self.query = query
+        self.options = options or []
+        self.per_page = per_page
+        self.page = page
+        self.endpoint = endpoint
+        self.sort_column = sort_column
+        self.id_column = id_column
+        self.kwargs = kwargs
+        if page < 1:
+            abort(404)
+
+        if count_query is None:
+            count_query = query
+        self.count = self.get_count(count_query, count_cache)
+        self.pages = max(1, (self.count + per_page - 1) / per_page)
+
+        self.entries, self.keys = self.get_entries()
+        self.has_previous = page > 1
+        self.has_next = page < self.pages
+
+    def get_count(self, count_query, count_cache):
+        """Return number of entries, from count_cache if possible"""
+        if count_cache is None:
+            return count_query.count()
+        key = ('count', self.endpoint, tuple(sorted(self.kwargs.items())))
+        count = count_cache.get(key)
+        if count is None:
+            count = count_query.count()
+            count_cache.set(key, count)
+        return count
+
+    def after(self, key):
+        """Filter for rows coming after key in descending order"""
+        return rows_after(self.sort_column, self.id_column, key)
+
+    def before(self, key):
+        """Filter for rows coming before key in descending order"""
+        return or_(self.sort_column > key[0],
+                   and_(self.sort_column == key[0], self.id_column > key[1]))
+
+    def seek(self):
+        """Return sort key of the last row before this page, None for page 1
+
+        Aborts with 404 Not Found if there is no such row.
+        """
+        offset = (self.page - 1) * self.per_page
+        if offset <= 0:
+            return None
+        key = self.query.with_entities(self.sort_column, self.id_column) \
+                .order_by(self.sort_column.desc(), self.id_column.desc()) \
+                .offset(offset - 1).limit(1).first()
+        if key is None:
+            abort(404)
+        return key
+
+    def get_entries(self):
+        """Return list of entries and list of their sort keys"""
+        query = self.query.add_columns(self.sort_column, self.id_column) \
+                .options(*self.options)
+        after = decode_cursor(request.args.get('after'))
+        before = decode_cursor(request.args.get('before'))
+
+        if before is not None:
+            rows = query.filter(self.before(before)) \
+                    .order_by(self.sort_column.asc(), self.id_column.asc()) \
+                    .limit(self.per_page).all()
+            rows.reverse()
+        else:
+            if after is None:
+                after = self.seek()
+            if after is not None:
+                query = query.filter(self.after(after))
+            rows = query \
+                    .order_by(self.sort_column.desc(), self.id_column.desc()) \
+                    .limit(self.per_page).all()
+        if not rows and self.page > 1:
+            abort(404)
+
+        entries = []
+        keys = []
+        for row in rows:
+            entry = tuple(row[:-2])
+            if len(entry) == 1:
+                entry = entry[0]
+            entries.append(entry)
+            keys.append(tuple(row[-2:]))
+        return entries, keys
+
+    def url(self, page, **args):
+        """Return URL of the given page"""
+        args.update(self.kwargs)
+        return url_for(self.endpoint, page=page, **args)
+
+    @property
+    def first(self):
+        return self.url(1)
+
+    @property
+    def last(self):
+        return self.url(self.pages)
+
+    @property
+    def previous(self):
+        if self.page - 1 <= 1 or not self.keys:
+            return self.url(max(1, self.page - 1))
+        return self.url(self.page - 1, before=encode_cursor(self.keys[0]))
+
+    @property
+    def next(self):
+        if not self.keys:
+            return self.url(self.page + 1)
+        return self.url(self.page + 1, after=encode_cursor(self.keys[-1]))
+# }}}
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Description {{{
+"""
+    imposter.profiling
+    ~~~~~~~~~~~~~~~~~~
+
+    Opt-in per request profiling for the Imposter weblog apps
+
+    When PROFILING is enabled, every request records the number of SQL
+    statements, the time spent executing them, the slowest statements, the
+    time spent rendering templates and the time taken by each context
+    processor. The totals are sent in the X-Imposter-Timing header and,
+    with PROFILING_FOOTER, as a comment at the end of html pages. Requests
+    taking longer than PROFILING_SLOW_REQUEST seconds are logged to the
+    'imposter.profiling' logger.
+
+    Statements executed outside of a request, such as those of the compile
+    workers, are not recorded.
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+from flask import g, request, has_request_context
+from functools import wraps
+from heapq import heappush, heappushpop
+from sqlalchemy import event
+from time import time
+
+import logging
+# }}}
+
+log = logging.getLogger('imposter.profiling')
+
+# Helper functions {{{
+def get_profile():
+    """Return the RequestProfile of the current request, None if the request
+    isn't profiled or there is no request"""
+    if not has_request_context():
+        return None
+    return getattr(g, 'profile', None)
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if get_profile() is not None:
+        conn.info.setdefault('query_start', []).append(time())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    profile = get_profile()
+    if profile is not None and conn.info.get('query_start'):
+        profile.add_query(statement, time() - conn.info['query_start'].pop())
+
+def instrument_engine(engine):
+    """Time the statements executed by engine, once per engine"""
+    if getattr(engine, 'profiled', False):
+        return
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    engine.profiled = True
+
+def timed(fun, name=None):
+    """Return function adding its running time to the request profile
+
+    :param name: name to record the time under, None to add it to the
+                 template render time
+    """
+    @wraps(fun)
+    def decorated_function(*args, **kwargs):
+        """Decorated function"""
+        profile = get_profile()
+        if profile is None:
+            return fun(*args, **kwargs)
+        start = time()
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            profile.add_time(name, time() - start)
+
+    decorated_function.profiled = True
+    return decorated_function
+
+def milliseconds(seconds):
+    return '%.1fms' % (seconds * 1000)
+# }}}
+
+# Classes {{{
+class RequestProfile(object):
+    """Timings of a single request
+
+    :param slowest: number of slowest statements to keep
+    """
+    def __init__(self, slowest=5):
+        self.start = time()
+        self.end = None
+        self.queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.timings = {}
+        self.slowest = slowest
+        self.statements = []
+
+    def add_query(self, statement, seconds):
+        self.queries += 1
+        self.sql_time += seconds
+        if len(self.statements) < self.slowest:
+            heappush(self.statements, (seconds, statement))
+        elif self.slowest:
+            heappushpop(self.statements, (seconds, statement))
+
+    def add_time(self, name, seconds):
+        if name is None:
+            self.render_time += seconds
+        else:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def finish(self):
+        self.end = time()
+
+    @property
+    def total_time(self):
+        return (self.end or time()) - self.start
+
+    def get_slowest(self):
+        """Return list of (seconds, statement) tuples, slowest first"""
+        return sorted(self.statements, reverse=True)
+
+    def header(self):
+        """Return value of the X-Imposter-Timing header"""
+        parts = ['total=%s' % milliseconds(self.total_time),
+                 'sql=%s' % milliseconds(self.sql_time),
+                 'queries=%d' % self.queries,
+                 'render=%s' % milliseconds(self.render_time)]
+        parts.extend('%s=%s' % (name, milliseconds(seconds))
+                     for name, seconds in sorted(self.timings.items()))
+        return '; '.join(parts)
+
+    def report(self):
+        """Return multi-line report with the slowest statements"""
+        lines = [self.header()]
+        lines.extend('%s %s' % (milliseconds(seconds), ' '.join(
+                     statement.split()))
+                     for seconds, statement in self.get_slowest())
+        return '\n'.join(lines)
+
+class Profiler(object):
+    """Profile the requests of app, if enabled in its config
+
+    Config keys are read with the given prefix, for example
+    PUBLIC_API_PROFILING for the prefix 'PUBLIC_API_'.
+
+    :param app: Flask application
+    :param engines: engines to time the statements of, see DB.get_engines
+    :param viewer: Viewer whose render method is timed, if any
+    :param prefix: prefix of the config keys
+    """
+    def __init__(self, app, engines, viewer=None, prefix=''):
+        self.app = app
+        self.enabled = app.config.get(prefix + 'PROFILING', False)
+        self.footer = app.config.get(prefix + 'PROFILING_FOOTER', False)
+        self.slow_request = app.config.get(prefix + 'PROFILING_SLOW_REQUEST')
+        self.slowest = app.config.get(prefix + 'PROFILING_SLOWEST', 5)
+        if not self.enabled:
+            return
+
+        for engine in engines:
+            instrument_engine(engine)
+        if viewer is not None:
+            viewer.render = timed(viewer.render)
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+
+    def instrument_context_processors(self):
+        """Time the context processors of the app, which are registered
+        after the Profiler is created"""
+        processors = self.app.template_context_processors[None]
+        for index, fun in enumerate(processors):
+            if not getattr(fun, 'profiled', False) and \
+                   not fun.__module__.startswith('flask'):
+                processors[index] = timed(fun, fun.__name__)
+
+    def start_request(self):
+        self.instrument_context_processors()
+        g.profile = RequestProfile(self.slowest)
+
+    def end_request(self, response):
+        profile = get_profile()
+        if profile is None:
+            return response
+        profile.finish()
+        response.headers['X-Imposter-Timing'] = profile.header()
+
+        if self.footer and response.status_code == 200 and \
+               response.mimetype == 'text/html' and \
+               not response.direct_passthrough:
+            report = profile.report().replace('--', '- -')
+            response.data = response.data + \
+                    '\n<!-- X-Imposter-Timing: %s -->\n' % report
+
+        if self.slow_request is not None and \
+               profile.total_time > self.slow_request:
+            log.warning('Slow request %s %s (%s): %s' %
+                        (request.method, request.path, request.endpoint,
+                         profile.report()))
+        return response
+# }}}
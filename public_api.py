@@ -14,12 +14,22 @@
 # }}}
 
 # {{{ Imports
-from flask import Flask, g, abort, jsonify
-from datetime import datetime
-from models import User, Tag, Status, Format, Post
-from sqlalchemy.sql import and_
-
-from database import DB
+from flask import Flask, g, request, abort, jsonify
+from functools import wraps
+from datetime import datetime, timedelta
+from time import time, mktime
+from models import User, Tag, Status, Format, Post, Page, PublishedPost, \
+                   Tombstone, post_tags, published_post_tags, tag_values
+from sqlalchemy.sql import and_, or_, func, case
+from sqlalchemy.orm import undefer
+
+from database import DB, db_options, eager_options
+from lookups import lookups
+from cache import TimedCache, MemoryBackend, create_backend
+from profiling import Profiler
+from metrics import Metrics, registry
+from pagination import encode_cursor, decode_cursor, rows_after, \
+                       CURSOR_DATE_FORMAT
 
 import os
 # }}}
@@ -28,18 +38,278 @@ import os
 app = Flask(__name__, static_path=None)
 app.config.from_pyfile('config.py')
 app.config.from_envvar('IMPOSTER_PUBLIC_API_CONFIG', silent=True)
-db_session = DB(app.config['PUBLIC_API_DATABASE']).get_session()
-
-# filter to make sure we only get posts which have status 'public'
-filter_public = and_(Post.status_id==Status.id,
-                 Status.value=='public',
-                 Post.user_id==User.id,
-                 Post.pubdate <= datetime.now()
-                 )
+db = DB(app.config['PUBLIC_API_DATABASE'],
+        **db_options(app.config, 'PUBLIC_API_DATABASE'))
+db_session = db.get_session()
+profiler = Profiler(app, db.get_engines(), prefix='PUBLIC_API_')
+metrics = Metrics(app, 'public_api', app.config['PUBLIC_API_PREFIX'],
+                  'PUBLIC_API_')
+
+# results of the queries, by time bucket
+result_cache = TimedCache(app.config['PUBLIC_API_TIME_BUCKET'],
+                          app.config['CACHE_STAMP_FILE'],
+                          MemoryBackend(app.config['PUBLIC_API_CACHE_SIZE']))
+registry.add_cache('public_api_result', result_cache)
+# }}}
 
-# base query used in all frontend retrieve queries
-posts_base = db_session.query(Post, Status, User).filter(filter_public)
+# Cache helpers {{{
+def next_publication():
+    """Return timestamp at which the first scheduled post shows up
+
+    That is the start of the first time bucket after its publication date.
+    Returns None if nothing is scheduled.
+    """
+    pubdate = db_session.query(func.min(PublishedPost.pubdate)).filter(
+        PublishedPost.pubdate > get_now()).scalar()
+    if pubdate is None:
+        return None
+    bucket = app.config['PUBLIC_API_TIME_BUCKET']
+    timestamp = mktime(pubdate.timetuple())
+    return timestamp - timestamp % bucket + bucket
+
+def last_modification():
+    """Return UTC datetime of the last modification or publication of a
+    published post"""
+    dates = db_session.query(func.max(Post.lastmoddate),
+                             func.max(PublishedPost.pubdate)) \
+            .filter(filter_public(get_now())).first()
+    dates = [date for date in dates if date is not None]
+    if not dates:
+        return None
+    return datetime.utcfromtimestamp(mktime(max(dates).timetuple()))
+
+# serialized responses of the views
+response_cache = TimedCache(app.config['PUBLIC_API_CACHE_TTL'],
+                            app.config['CACHE_STAMP_FILE'],
+                            create_backend(
+                                app.config['PUBLIC_API_CACHE_BACKEND'],
+                                app.config['PUBLIC_API_CACHE_SIZE'],
+                                app.config['PUBLIC_API_CACHE_DIR']),
+                            get_expires=next_publication)
+registry.add_cache('public_api_response', response_cache)
+# }}}
 
+# Query helpers {{{
+def get_now():
+    """Return current time, rounded down to PUBLIC_API_TIME_BUCKET seconds
+
+    All requests within the same bucket use the same time in their queries,
+    so the results can be cached for the rest of the bucket.
+    """
+    bucket = app.config['PUBLIC_API_TIME_BUCKET']
+    timestamp = time()
+    return datetime.fromtimestamp(timestamp - timestamp % bucket)
+
+def filter_public(now):
+    """Filter to make sure we only get posts which are published at now"""
+    return and_(Post.id==PublishedPost.post_id,
+                PublishedPost.pubdate <= now,
+                Post.status_id==Status.id,
+                Post.user_id==User.id)
+
+def posts_base(now):
+    """Base query used to retrieve single posts"""
+    return db_session.query(Post, Status, User).filter(filter_public(now)) \
+            .options(*eager_options(app.config['PUBLIC_API_EAGER_LOADING'],
+                                    Post.tags))
+
+def post_rows_base(now):
+    """Base query used to retrieve lists of posts as row tuples
+
+    The rows hold the post id, the username and the public columns of the
+    post, see get_post_dicts.
+    """
+    return db_session.query(Post.id, User.username,
+                            *Post.__serializer__.columns) \
+            .filter(filter_public(now))
+
+def get_post_dicts(rows):
+    """Return list of public dicts of rows of post_rows_base"""
+    tags = tag_values(db_session, [row[0] for row in rows])
+    date_format = app.config['POST_DATETIME_FORMAT']
+    post_dicts = []
+    for row in rows:
+        post_dict = Post.__serializer__.from_row(row, date_format, 2)
+        post_dict['username'] = row[1]
+        post_dict['tags'] = tags[row[0]]
+        post_dicts.append(post_dict)
+    return post_dicts
+
+def cached_by_time(fun):
+    """Decorator calling fun(now, *args) and caching its return value by
+    arguments and time bucket"""
+    @wraps(fun)
+    def decorated_function(*args):
+        """Decorated function"""
+        now = get_now()
+        key = (fun.__name__, args, now)
+        value = result_cache.get(key)
+        if value is None:
+            value = fun(now, *args)
+            result_cache.set(key, value)
+        return value
+    return decorated_function
+
+@cached_by_time
+def get_post_by_slug(now, slug):
+    """Return public dict of the post with the given slug, None if the post
+    isn't published"""
+    post_result = posts_base(now).filter(PublishedPost.slug==slug) \
+            .options(undefer(Post.summary_html),
+                     undefer(Post.content_html)).first()
+    if post_result is None:
+        return None
+    return get_public_post_dict(post_result[0], post_result[2])
+
+def page_of_posts(query, after, limit):
+    """Return rows of a page of posts, newest first, and the cursor of the
+    next page or None if this is the last
+
+    :param query: query selecting at least Post.id and Post.pubdate
+    :param after: sort key of the last post of the previous page, or None
+    """
+    if after is not None:
+        query = query.filter(rows_after(PublishedPost.pubdate,
+                                        PublishedPost.post_id, after))
+    rows = query.order_by(PublishedPost.pubdate.desc(),
+                          PublishedPost.post_id.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor((rows[-1].pubdate, rows[-1].id))
+
+@cached_by_time
+def get_latest_slugs(now, after, limit):
+    """Return list of [pubdate, slug] lists of the latest posts and the
+    cursor of the next page"""
+    posts = db_session.query(Post.id, Post.pubdate, Post.slug) \
+            .filter(filter_public(now))
+    posts, next = page_of_posts(posts, after, limit)
+    return ([[post.pubdate.strftime(app.config['POST_DATETIME_FORMAT']),
+              post.slug] for post in posts], next)
+
+@cached_by_time
+def get_latest_post_dicts(now, after, limit):
+    """Return list of public dicts of the latest posts and the cursor of the
+    next page"""
+    posts, next = page_of_posts(post_rows_base(now), after, limit)
+    return (get_post_dicts(posts), next)
+
+@cached_by_time
+def get_slugs_by_tag(now, tag_id, after, limit):
+    """Return list of slugs of the posts with the given tag and the cursor
+    of the next page"""
+    posts = db_session.query(Post.id, Post.pubdate, Post.slug) \
+            .filter(filter_public(now)).filter(and_(
+                published_post_tags.c.post_id==PublishedPost.post_id,
+                published_post_tags.c.tag_id==tag_id))
+    posts, next = page_of_posts(posts, after, limit)
+    return ([post.slug for post in posts], next)
+
+@cached_by_time
+def get_posts_by_slugs(now, slugs):
+    """Return list of public dicts of the published posts with the given
+    slugs"""
+    posts = post_rows_base(now).filter(PublishedPost.slug.in_(slugs)) \
+            .order_by(PublishedPost.pubdate.desc(),
+                      PublishedPost.post_id.desc())
+    return get_post_dicts(posts.all())
+
+def changes_between(query, date, since, until, limit=None):
+    """Return rows of query with date in (since, until], oldest first
+
+    The date is added as the last column of the rows. At most limit + 1
+    rows are returned, so the caller can tell whether there are more.
+    """
+    query = query.add_columns(date) \
+            .filter(and_(date > since, date <= until)).order_by(date)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    return query.all()
+
+def get_change_queries(since, until):
+    """Return list of (query, date) tuples of posts, pages and tombstones
+
+    The date of posts and pages is their last modification or publication,
+    whichever came last. The queries are filtered on both dates separately
+    first, so the indexes on them can be used.
+    """
+    post_date = case([(Post.lastmoddate > PublishedPost.pubdate,
+                       Post.lastmoddate)], else_=PublishedPost.pubdate)
+    posts = post_rows_base(until).filter(or_(Post.lastmoddate > since,
+                                             PublishedPost.pubdate > since))
+    page_date = case([(Page.lastmoddate > Page.pubdate, Page.lastmoddate)],
+                     else_=Page.pubdate)
+    pages = db_session.query(*Page.__serializer__.columns).filter(and_(
+        Page.status_id==lookups.get_id(db_session, Status, 'public'),
+        Page.pubdate <= until,
+        or_(Page.lastmoddate > since, Page.pubdate > since)))
+    tombstones = db_session.query(Tombstone)
+    return [(posts, post_date), (pages, page_date),
+            (tombstones, Tombstone.createdate)]
+
+@cached_by_time
+def get_changes(now, since, limit):
+    """Return dict of posts, pages, tags and tombstones changed after since
+
+    Changes of the last PUBLIC_API_CHANGES_DELAY seconds are left out, as
+    transactions writing them may not be committed yet. If there are more
+    than limit posts, pages or tombstones, only the oldest changes are
+    returned, and 'more' is True. The 'next' cursor is the since argument
+    to use for the next request.
+    """
+    until = now - timedelta(seconds=app.config['PUBLIC_API_CHANGES_DELAY'])
+    until = max(until, since)
+    queries = get_change_queries(since, until)
+    results = [changes_between(query, date, since, until, limit)
+               for query, date in queries]
+
+    cutoff = until
+    for rows in results:
+        if len(rows) > limit:
+            cutoff = min(cutoff, rows[limit][-1] - timedelta(microseconds=1))
+    if cutoff < until:
+        if cutoff <= since:
+            # more than limit changes at a single moment, return them all
+            cutoff += timedelta(microseconds=1)
+        results = [changes_between(query, date, since, cutoff)
+                   for query, date in queries]
+    posts, pages, tombstones = results
+
+    date_format = app.config['POST_DATETIME_FORMAT']
+    tags = []
+    if posts:
+        tags = db_session.query(Tag.value, Tag.count).filter(and_(
+            post_tags.c.tag_id==Tag.id,
+            post_tags.c.post_id.in_([row[0] for row in posts]))) \
+            .distinct().order_by(Tag.value).all()
+    return {
+        'posts': get_post_dicts(posts),
+        'pages': Page.__serializer__.from_rows(pages, date_format),
+        'tags': [dict(value=value, count=count) for value, count in tags],
+        'deleted': [dict(type=tombstone.type,
+                         slug=tombstone.slug,
+                         date=tombstone.createdate.strftime(date_format))
+                    for tombstone, date in tombstones],
+        'next': cutoff.strftime(CURSOR_DATE_FORMAT),
+        'more': cutoff < until,
+        }
+
+def get_tags(after, limit):
+    """Return list of tag values ordered by id and the cursor of the next
+    page
+
+    :param after: id of the last tag of the previous page, or None
+    """
+    tags = db_session.query(Tag.id, Tag.value)
+    if after is not None:
+        tags = tags.filter(Tag.id > after)
+    tags = tags.order_by(Tag.id).limit(limit + 1).all()
+    next = None
+    if len(tags) > limit:
+        tags = tags[:limit]
+        next = str(tags[-1].id)
+    return [tag.value for tag in tags], next
 # }}}
 
 # Shortcut functions {{{
@@ -48,11 +318,41 @@ def get_route(function):
     """Return complete route based on configuration and routes"""
     return '/%s%s' % (app.config['PUBLIC_API_PREFIX'], app.config['PUBLIC_API_ROUTES'][function])
 
+def get_limit(default):
+    """Return number of entries requested by the limit argument, at most
+    PUBLIC_API_MAX_LIMIT"""
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        abort(400)
+    return max(1, min(limit, app.config['PUBLIC_API_MAX_LIMIT']))
+
+def get_after():
+    """Return sort key given by the after argument, None for the first page"""
+    cursor = request.args.get('after')
+    if cursor is None:
+        return None
+    key = decode_cursor(cursor)
+    if key is None:
+        abort(400)
+    return key
+
+def get_since():
+    """Return datetime given by the since argument, either a cursor from
+    the change feed or a UNIX timestamp. Returns the epoch if missing."""
+    since = request.args.get('since')
+    if since is None:
+        return datetime.fromtimestamp(0)
+    try:
+        if len(since) <= 10:
+            return datetime.fromtimestamp(int(since))
+        return datetime.strptime(since, CURSOR_DATE_FORMAT)
+    except ValueError:
+        abort(400)
+
 def get_public_post_dict(post, user):
     """Return a dict containing public post data"""
-    post_dict = post.get_public_dict()
-    post_dict['pubdate'] = post.pubdate.strftime(app.config['POST_DATETIME_FORMAT'])
-    post_dict['lastmoddate'] = post.lastmoddate.strftime(app.config['POST_DATETIME_FORMAT'])
+    post_dict = post.get_public_dict(app.config['POST_DATETIME_FORMAT'])
     post_dict['username'] = user.username
 
     return post_dict
@@ -67,63 +367,83 @@ def shutdown_session(response):
 # Views {{{
 
 @app.route(get_route('json_post_by_slug'))
+@response_cache.cached_view(last_modification)
 def json_post_by_slug(slug):
     """Retrieve Post selected by slug in JSON format"""
-    post_result = posts_base.filter(Post.slug==slug).first()
-    if post_result is None:
+    post_dict = get_post_by_slug(slug)
+    if post_dict is None:
         abort(404)
-    post_dict = get_public_post_dict(post_result[0], post_result[2])
     return jsonify(post_dict)
 
 @app.route(get_route('json_status_by_id'))
+@response_cache.cached_view(last_modification)
 def json_status_by_id(id):
     """List of statuses in the database"""
     status = Status.query.filter(Status.id==id).first()
     if status is None:
         abort(404)
-    return jsonify(status.get_public_dict())
+    return jsonify(status.get_public_dict(app.config['POST_DATETIME_FORMAT']))
 
 @app.route(get_route('json_format_by_id'))
+@response_cache.cached_view(last_modification)
 def json_format_by_id(id):
     """List of formats in the database"""
     fmt = Format.query.filter(Format.id==id).first()
     if fmt is None:
         abort(404)
-    return jsonify(fmt.get_public_dict())
+    return jsonify(fmt.get_public_dict(app.config['POST_DATETIME_FORMAT']))
 
 @app.route(get_route('json_user_by_id'))
+@response_cache.cached_view(last_modification)
 def json_user_by_id(id):
     """List of usernames in the database"""
     user = User.query.filter(User.id==id).first()
     if user is None:
         abort(404)
-    return jsonify(user.get_public_dict())
+    return jsonify(user.get_public_dict(app.config['POST_DATETIME_FORMAT']))
 
 @app.route(get_route('json_sluglist_latest'))
+@response_cache.cached_view(last_modification)
 def json_sluglist_latest():
     """List of post slugs (by post publication date) in the database"""
-    posts = posts_base.order_by(Post.pubdate.desc())[:app.config['FEEDITEMS']]
-    out = {'posts': []}
-    for post in posts:
-        out['posts'].append([post[0].pubdate.strftime(app.config['POST_DATETIME_FORMAT']), post[0].slug])
-
-    return jsonify(out)
+    slugs, next = get_latest_slugs(get_after(),
+                                   get_limit(app.config['FEEDITEMS']))
+    return jsonify({'posts': slugs, 'next': next})
 
 @app.route(get_route('json_posts_latest'))
+@response_cache.cached_view(last_modification)
 def json_posts_latest():
     """Latest posts (by publication date) in the database"""
-    posts = posts_base.order_by(Post.pubdate.desc())[:app.config['FEEDITEMS']]
-    out = {'posts': []}
-    for post_result in posts:
-        post_dict = get_public_post_dict(post_result[0], post_result[2])
-        out['posts'].append(post_dict)
-
-    return jsonify(out)
+    posts, next = get_latest_post_dicts(get_after(),
+                                        get_limit(app.config['FEEDITEMS']))
+    return jsonify({'posts': posts, 'next': next})
+
+@app.route(get_route('json_posts_by_slugs'))
+@response_cache.cached_view(last_modification)
+def json_posts_by_slugs():
+    """Published posts selected by a comma separated list of slugs"""
+    slugs = tuple(sorted(set(slug for slug in
+                             request.args.get('slugs', '').split(',')
+                             if slug)))
+    if not slugs:
+        abort(400)
+    if len(slugs) > app.config['PUBLIC_API_MAX_LIMIT']:
+        abort(400)
+    return jsonify({'posts': get_posts_by_slugs(slugs)})
+
+@app.route(get_route('json_changes'))
+@response_cache.cached_view(last_modification)
+def json_changes():
+    """Posts, pages and tags changed and posts and pages removed since the
+    given cursor or timestamp"""
+    return jsonify(get_changes(get_since(),
+                               get_limit(app.config['PUBLIC_API_PAGE_SIZE'])))
 
 @app.route(get_route('json_statuslist'))
+@response_cache.cached_view(last_modification)
 def json_statuslist():
     """List of statuses in the database"""
-    statuses = Status.query.all()
+    statuses = lookups.all(db_session, Status)
     out = {'statuses': []}
     for status in statuses:
         out['statuses'].append(status.value)
@@ -131,27 +451,28 @@ def json_statuslist():
     return jsonify(out)
 
 @app.route(get_route('json_taglist'))
+@response_cache.cached_view(last_modification)
 def json_taglist():
     """List of tags in the database"""
-    tags = Tag.query.all()
-    out = {'tags': []}
-    for tag in tags:
-        out['tags'].append(tag.value)
-
-    return jsonify(out)
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            after = int(after)
+        except ValueError:
+            abort(400)
+    tags, next = get_tags(after, get_limit(app.config['PUBLIC_API_PAGE_SIZE']))
+    return jsonify({'tags': tags, 'next': next})
 
 @app.route(get_route('json_sluglist_by_tag'))
+@response_cache.cached_view(last_modification)
 def json_sluglist_by_tag(tag):
     """Render a post list filtered by tag"""
     tagobj = Tag.query.filter(Tag.value==tag).first()
     if tagobj is None:
         abort(404)
-    posts = posts_base.filter(Post.tags.contains(tagobj))
-    out = {'posts': []}
-    for post in posts:
-        out['posts'].append(post[0].slug)
-
-    return jsonify(out)
+    slugs, next = get_slugs_by_tag(tagobj.id, get_after(),
+                                   get_limit(app.config['PUBLIC_API_PAGE_SIZE']))
+    return jsonify({'posts': slugs, 'next': next})
 # }}}
 
 # Main run loop {{{
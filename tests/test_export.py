@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Description {{{
+"""
+    imposter.tests.test_export
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The static export finds the URLs of everything published
+
+    The frontend uses an in-memory SQLite database filled by
+    benchmarks/dataset.py.
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+import os
+import sys
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from datetime import datetime
+from tempfile import mkstemp
+
+import re
+import unittest
+# }}}
+
+CONFIG = """
+DEBUG = False
+DATABASE = 'sqlite://'
+CACHE_STAMP_FILE = None
+PAGE_CACHE_BACKEND = None
+"""
+
+class ExportTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        handle, cls.config_file = mkstemp(suffix='.py')
+        os.write(handle, CONFIG)
+        os.close(handle)
+        os.environ['IMPOSTER_FRONTEND_CONFIG'] = cls.config_file
+        os.chdir(ROOT)
+
+        import export
+        from database import Base, engines
+        from dataset import generate
+        from models import PublishedPost
+        cls.export = export
+        cls.app = export.app
+
+        engine = engines['sqlite://']
+        Base.metadata.create_all(engine)
+        generate(engine, posts=30, users=2, tags=3, summary_size=50,
+                 content_size=100)
+        cls.published = export.db_session.query(PublishedPost) \
+                .filter(PublishedPost.pubdate <= datetime.now()).count()
+        export.db_session.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.config_file)
+
+    def test_get_targets(self):
+        with self.app.test_request_context():
+            targets = self.export.get_targets()
+        urls = [url for url, sig in targets]
+        self.assertEqual(len(urls), len(set(urls)))
+
+        prefix = '/' + self.app.config['PREFIX']
+        now = datetime.now()
+        for url in ['list/1.html', '%d/' % now.year, '%d/1.html' % now.year,
+                    '%d/%02d/' % (now.year, now.month), 'tag/tag1/',
+                    'tag/tag1/1.html', 'user/user1/1.html', 'feed/rss/']:
+            self.assertTrue(prefix + url in urls, url)
+        posts = [url for url in urls
+                 if re.match(r'%s\d{4}/\d\d/\d\d/post-\d+\.html$' % prefix,
+                             url)]
+        self.assertEqual(len(posts), self.published)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# Description {{{
+"""
+    imposter.tests.test_query_counts
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The number of SQL statements of the list views and feeds doesn't depend
+    on the number of posts shown
+
+    Both apps use an in-memory SQLite database filled by
+    benchmarks/dataset.py, without the page and response caches. Every view
+    is requested once to fill the sidebar cache and the per process lookups,
+    then once with a small and once with a large page size.
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+from __future__ import with_statement
+import os
+import sys
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from datetime import datetime
+from tempfile import mkstemp
+
+import re
+import unittest
+# }}}
+
+# settings of both apps, without caching whole responses
+CONFIG = """
+DEBUG = False
+DATABASE = 'sqlite://'
+PUBLIC_API_DATABASE = 'sqlite://'
+CACHE_STAMP_FILE = None
+PAGE_CACHE_BACKEND = None
+PUBLIC_API_CACHE_BACKEND = None
+PUBLIC_API_CACHE_SIZE = 0
+PROFILING = False
+PUBLIC_API_PROFILING = False
+METRICS_PATH = None
+PUBLIC_API_METRICS_PATH = None
+"""
+
+# page sizes compared
+SMALL = 2
+LARGE = 10
+
+# maximum number of statements of a single list view
+MAX_QUERIES = 6
+
+def build_url(prefix, pattern, **values):
+    """Return URL for a route pattern like 'tag/<tag>/<int:page>.html'"""
+    return '/%s%s' % (prefix, re.sub(r'<(?:\w+:)?(\w+)>',
+                                     lambda match: str(values[match.group(1)]),
+                                     pattern))
+
+class QueryCountTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        handle, cls.config_file = mkstemp(suffix='.py')
+        os.write(handle, CONFIG)
+        os.close(handle)
+        os.environ['IMPOSTER_FRONTEND_CONFIG'] = cls.config_file
+        os.environ['IMPOSTER_PUBLIC_API_CONFIG'] = cls.config_file
+        os.chdir(ROOT)
+
+        import frontend
+        import public_api
+        from sqlalchemy import event
+        from database import Base, engines
+        from dataset import generate
+        cls.frontend = frontend.app
+        cls.public_api = public_api.app
+
+        engine = engines['sqlite://']
+        Base.metadata.create_all(engine)
+        generate(engine, posts=100, users=2, tags=5, summary_size=50,
+                 content_size=100)
+        event.listen(engine, 'before_cursor_execute', cls.count_query)
+        cls.now = datetime.now()
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.config_file)
+
+    queries = 0
+
+    @classmethod
+    def count_query(cls, *args):
+        cls.queries += 1
+
+    def count(self, app, url, key, size):
+        """Return number of statements executed when requesting url with the
+        config key set to size"""
+        app.config[key] = size
+        client = app.test_client()
+        QueryCountTest.queries = 0
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        return QueryCountTest.queries
+
+    def check(self, app, url, key='ENTRIES_PER_PAGE'):
+        """Check url executes the same, small number of statements for both
+        page sizes"""
+        self.count(app, url, key, LARGE)
+        small = self.count(app, url, key, SMALL)
+        large = self.count(app, url, key, LARGE)
+        self.assertEqual(small, large, '%s: %d statements for %d posts, %d '
+                         'for %d posts' % (url, small, SMALL, large, LARGE))
+        self.assertTrue(large <= MAX_QUERIES, '%s: %d statements' %
+                        (url, large))
+
+    def frontend_url(self, name, **values):
+        return build_url(self.frontend.config['PREFIX'],
+                         self.frontend.config['ROUTES'][name], **values)
+
+    def test_postlist(self):
+        self.check(self.frontend, self.frontend_url('show_postlist', page=1))
+
+    def test_postlist_by_tag(self):
+        self.check(self.frontend, self.frontend_url('show_postlist_by_tag',
+                                                    tag='tag1', page=1))
+
+    def test_postlist_by_username(self):
+        self.check(self.frontend,
+                   self.frontend_url('show_postlist_by_username',
+                                     username='user1', page=1))
+
+    def test_postlist_by_year(self):
+        self.check(self.frontend, self.frontend_url('show_postlist_by_year',
+                                                    year=self.now.year,
+                                                    page=1))
+
+    def test_postlist_by_month(self):
+        self.check(self.frontend, self.frontend_url('show_postlist_by_month',
+                                                    year=self.now.year,
+                                                    month='%02d' %
+                                                          self.now.month,
+                                                    page=1))
+
+    def test_rss(self):
+        self.check(self.frontend, self.frontend_url('show_rss'), 'FEEDITEMS')
+
+    def test_atom(self):
+        self.check(self.frontend, self.frontend_url('show_atom'), 'FEEDITEMS')
+
+    def test_json_posts_latest(self):
+        url = build_url(self.public_api.config['PUBLIC_API_PREFIX'],
+                        self.public_api.config['PUBLIC_API_ROUTES']
+                        ['json_posts_latest'])
+        self.check(self.public_api, url, 'FEEDITEMS')
+
+if __name__ == '__main__':
+    unittest.main()
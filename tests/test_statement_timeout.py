@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# Description {{{
+"""
+    imposter.tests.test_statement_timeout
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The statement timeout set on new PostgreSQL connections survives the
+    rollbacks of the pool and of requests
+
+    Needs a PostgreSQL database, given by the IMPOSTER_TEST_POSTGRESQL
+    environment variable, for example postgresql://imposter@localhost/test.
+    Skipped otherwise.
+
+    :copyright: (c) 2010-2011 by Jochem Kossen.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+# }}}
+
+# Imports {{{
+import os
+import sys
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import unittest
+# }}}
+
+DATABASE = os.environ.get('IMPOSTER_TEST_POSTGRESQL')
+
+@unittest.skipUnless(DATABASE, 'IMPOSTER_TEST_POSTGRESQL is not set')
+class StatementTimeoutTest(unittest.TestCase):
+    def test_timeout_after_rollback(self):
+        from database import get_engine
+        engine = get_engine(DATABASE, pool_size=1, max_overflow=0,
+                            statement_timeout=2)
+
+        conn = engine.connect()
+        trans = conn.begin()
+        self.assertEqual(conn.execute('SHOW statement_timeout').scalar(),
+                         '2s')
+        trans.rollback()
+        # the pool rolls back connections when they are returned
+        conn.close()
+
+        conn = engine.connect()
+        try:
+            self.assertEqual(conn.execute('SHOW statement_timeout').scalar(),
+                             '2s')
+        finally:
+            conn.close()
+
+if __name__ == '__main__':
+    unittest.main()